@@ -0,0 +1,748 @@
+"""Benchmarks the planning pipeline against a local stand-in for the OpenAI API.
+
+The fake server speaks the chat completions protocol (plain, streamed and tool calls) with
+configurable latency distributions, token rates and injected errors, so the client stack
+(shared clients, scheduler, retries, agents, evals) can be measured without a live
+endpoint. Scripted scenarios cover the three hot paths of the trip planner:
+
+* ``itinerary``: an itinerary request through ChatAgent, parsed into a TravelPlan.
+* ``revision``: a tool-calling revision loop (ChatAgent.get_tool_response + ToolExecutor).
+* ``evals``: get_eval_results with the LLM-backed weather eval.
+
+Run it from this directory, e.g.::
+
+    python benchmark.py --trips 50 --concurrency 8 --latency lognormal:0.2:0.5 --error-rate 0.05
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json  # exits with 1 on a regression
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models import TravelPlan, VacationInfo
+from utils import OpenAIModel
+
+BENCHMARK_VACATION_INFO = {
+    "travelers": [
+        {"name": "Yuri", "age": 30, "interests": ["tennis", "cooking", "comedy", "technology"]},
+        {"name": "Hiro", "age": 25, "interests": ["reading", "music", "theatre", "art"]},
+    ],
+    "destination": "AgentsVille",
+    "date_of_arrival": "2025-06-10",
+    "date_of_departure": "2025-06-12",
+    "budget": 130,
+}
+
+WEATHER_VERDICT_PROMPT = """
+You are a weather expert. Decide whether the activity can take place in the given weather.
+
+FINAL ANSWER:
+[IS_COMPATIBLE, IS_INCOMPATIBLE]
+""".strip()
+
+
+def constant_latency(seconds):
+    """Returns a latency sampler that always waits `seconds`."""
+    return lambda rng: seconds
+
+
+def uniform_latency(low, high):
+    """Returns a latency sampler drawing uniformly from [low, high] seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma):
+    """Returns a latency sampler with a log-normal distribution, the usual shape of API latency.
+
+    Args:
+        median (float): The median latency in seconds.
+        sigma (float): The standard deviation of the underlying normal; larger values
+            give a longer tail.
+    """
+    import math
+
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def parse_latency(spec):
+    """Parses a latency spec: "constant:S", "uniform:LOW:HIGH" or "lognormal:MEDIAN:SIGMA".
+
+    Raises:
+        ValueError: If the spec is not one of the above.
+    """
+    kind, *params = spec.split(":")
+    samplers = {"constant": constant_latency, "uniform": uniform_latency, "lognormal": lognormal_latency}
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {kind}")
+    return samplers[kind](*map(float, params))
+
+
+def count_tokens(text) -> int:
+    """Estimates tokens at four characters each, like the fake server bills them."""
+    return (len(text) + 3) // 4
+
+
+class FakeOpenAIServer:
+    """A local HTTP server answering OpenAI chat completion requests.
+
+    Every request is answered by `responder`, which gets the request JSON and returns
+    either the content string or an assistant message dict (with `tool_calls`). The
+    server then waits the sampled latency (the time to first token) plus the completion
+    tokens at `tokens_per_second`, streaming the content in chunks when asked to.
+
+    Args:
+        responder (callable): Maps the request JSON to the response content or message.
+        latency (callable, optional): Samples the time to first token in seconds from a
+            random.Random, e.g. lognormal_latency(0.2, 0.5). Defaults to no latency.
+        tokens_per_second (float, optional): The completion token rate. None means instant.
+        error_rate (float): The share of requests answered with an injected error.
+        error_statuses (tuple): The HTTP statuses injected errors are drawn from.
+        retry_after (float, optional): The Retry-After of injected errors, in seconds.
+        seed (int, optional): Seeds the latency and error draws.
+
+    Examples:
+        >>> with FakeOpenAIServer(lambda request: "Hello!") as server:
+        ...     from openai import OpenAI
+        ...     client = OpenAI(base_url=server.url, api_key="benchmark")
+        ...     client.chat.completions.create(model="gpt-4.1-nano", messages=[]).choices[0].message.content
+        'Hello!'
+    """
+
+    def __init__(
+        self,
+        responder,
+        latency=None,
+        tokens_per_second=None,
+        error_rate=0.0,
+        error_statuses=(429, 500, 503),
+        retry_after=None,
+        seed=None,
+    ):
+        self.responder = responder
+        self.latency = latency or constant_latency(0.0)
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._httpd = None
+        self._thread = None
+        self.reset_stats()
+
+    @property
+    def url(self) -> str:
+        """The base_url to give the OpenAI client."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Starts serving on a free local port in a background thread."""
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _FakeOpenAIHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake_server = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the server."""
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self) -> dict:
+        """Returns the requests, injected errors and billed tokens since the last reset."""
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def _draw(self):
+        """Returns the latency and the injected error status (or None) of a request."""
+        with self._lock:
+            self._stats["requests"] += 1
+            latency = max(0.0, self.latency(self._rng))
+            if self._rng.random() < self.error_rate:
+                self._stats["errors"] += 1
+                return latency, self._rng.choice(self.error_statuses)
+            return latency, None
+
+    def _bill(self, prompt_tokens, completion_tokens):
+        with self._lock:
+            self._stats["prompt_tokens"] += prompt_tokens
+            self._stats["completion_tokens"] += completion_tokens
+
+    def _generation_time(self, completion_tokens):
+        return completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _next_id(self):
+        with self._lock:
+            return f"chatcmpl-fake-{next(self._ids)}"
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, so the client's connection pool is exercised as in production
+    protocol_version = "HTTP/1.1"
+    STREAM_CHUNK_TOKENS = 8
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server.fake_server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+
+        latency, error_status = server._draw()
+        if error_status is not None:
+            time.sleep(latency)
+            headers = {}
+            if server.retry_after is not None:
+                headers["retry-after-ms"] = str(int(server.retry_after * 1000))
+            return self._send_json(
+                error_status,
+                {"error": {"message": "Injected error", "type": "server_error", "code": error_status}},
+                headers,
+            )
+
+        message = server.responder(request)
+        if isinstance(message, str):
+            message = {"role": "assistant", "content": message}
+        message.setdefault("role", "assistant")
+        message.setdefault("content", None)
+
+        prompt_tokens = sum(
+            count_tokens(str(prompt_message.get("content") or ""))
+            + count_tokens(json.dumps(prompt_message.get("tool_calls") or ""))
+            for prompt_message in request.get("messages", [])
+        )
+        completion_text = (message["content"] or "") + json.dumps(message.get("tool_calls") or "")
+        completion_tokens = count_tokens(completion_text)
+        server._bill(prompt_tokens, completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+        time.sleep(latency)
+
+        if request.get("stream"):
+            return self._send_stream(server, request, message, usage, finish_reason)
+
+        time.sleep(server._generation_time(completion_tokens))
+        self._send_json(
+            200,
+            {
+                "id": server._next_id(),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [
+                    {"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, server, request, message, usage, finish_reason):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = server._next_id()
+
+        def send_chunk(choices, **extra):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": choices,
+                **extra,
+            }
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n")
+
+        content = message["content"] or ""
+        piece_chars = self.STREAM_CHUNK_TOKENS * 4
+        for start in range(0, len(content), piece_chars):
+            piece = content[start:start + piece_chars]
+            send_chunk([{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}])
+            time.sleep(server._generation_time(count_tokens(piece)))
+        send_chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_chunk([], usage=usage)
+        self._write_chunk("data: [DONE]\n\n")
+        self._write_chunk("")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_trip_planner_responder(travel_plan: TravelPlan):
+    """Returns a responder scripting the model's side of the three scenarios.
+
+    * Weather verdict prompts get IS_COMPATIBLE.
+    * Tool-calling requests walk the revision loop by the number of tool results so far:
+      fetch the activities of every day (parallel calls), run the evals, give the final answer.
+    * Anything else is an itinerary request and gets travel_plan in the ANALYSIS / FINAL
+      OUTPUT format.
+    """
+    plan_json = travel_plan.model_dump_json()
+    dates = [str(itinerary_day.date) for itinerary_day in travel_plan.itinerary_days]
+
+    def tool_call(index, name, arguments):
+        return {
+            "id": f"call_{index}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)},
+        }
+
+    def respond(request):
+        messages = request.get("messages", [])
+        system_prompt = (messages[0].get("content") or "") if messages else ""
+        if "IS_COMPATIBLE" in system_prompt:
+            return "REASONING:\n* The activity is not affected by the weather.\n\nFINAL ANSWER:\nIS_COMPATIBLE"
+
+        if request.get("tools"):
+            step = sum(message["role"] == "assistant" for message in messages)
+            if step == 0:
+                tool_calls = [
+                    tool_call(index, "get_activities_by_date_tool", {"date": date, "city": travel_plan.city})
+                    for index, date in enumerate(dates)
+                ]
+            elif step == 1:
+                tool_calls = [tool_call(0, "run_evals_tool", {"travel_plan": json.loads(plan_json)})]
+            else:
+                tool_calls = [tool_call(0, "final_answer_tool", {"final_output": json.loads(plan_json)})]
+            return {"role": "assistant", "content": None, "tool_calls": tool_calls}
+
+        return (
+            "ANALYSIS:\n* The activities do not overlap and fit the weather and the budget.\n\n"
+            f"FINAL OUTPUT:\n```json\n{plan_json}\n```"
+        )
+
+    return respond
+
+
+def run_itinerary_trip(client, vacation_info, model=OpenAIModel.GPT_41_MINI, stream=False):
+    """Plans one trip the way ItineraryAgent.get_itinerary does."""
+    from utils import (
+        ChatAgent,
+        call_activities_api_mocked,
+        call_weather_api_mocked,
+        parse_travel_plan_stream,
+    )
+    days = (vacation_info.date_of_departure - vacation_info.date_of_arrival).days
+    dates = [
+        (vacation_info.date_of_arrival + datetime.timedelta(days=offset)).isoformat()
+        for offset in range(days + 1)
+    ]
+    agent = ChatAgent(
+        name="BenchmarkItineraryAgent",
+        system_prompt=(
+            "You are an Itinerary Planning Agent. Plan an itinerary for the travelers.\n\n"
+            "Respond with ANALYSIS and FINAL OUTPUT sections; the FINAL OUTPUT is a JSON object "
+            f"that validates as TravelPlan: {TravelPlan.model_json_schema()}"
+        ),
+        prompt_context=(
+            f"Weather Data:\n{[call_weather_api_mocked(date, vacation_info.destination) for date in dates]}\n\n"
+            f"Activities:\n{[call_activities_api_mocked(date=date, city=vacation_info.destination) for date in dates]}"
+        ),
+        client=client,
+        model=model,
+    )
+    response = agent.chat(
+        user_message=vacation_info.model_dump_json(indent=2),
+        add_to_messages=False,
+        stream=stream,
+    )
+    travel_plan, _ = parse_travel_plan_stream([response or ""])
+    return travel_plan
+
+
+def run_revision_trip(client, vacation_info, travel_plan, model=OpenAIModel.GPT_41_MINI, max_steps=6):
+    """Revises one plan with native tool calls, like ItineraryRevisionAgent.run_react_cycle(native_tools=True)."""
+    from test import DETERMINISTIC_EVAL_FUNCTIONS, get_eval_results
+    from utils import ChatAgent, ToolExecutor, get_activity_catalog
+
+    def get_activities_by_date_tool(date: str, city: str) -> list:
+        """Retrieves the activities for a date and city.
+
+        Args:
+            date (str): The date (YYYY-MM-DD).
+            city (str): The city.
+        """
+        catalog = get_activity_catalog()
+        return [catalog.get_dump(activity["activity_id"]) for activity in catalog.get_by_date(date, city)]
+
+    def run_evals_tool(travel_plan: TravelPlan) -> dict:
+        """Runs the evaluations on a travel plan.
+
+        Args:
+            travel_plan (TravelPlan): The travel plan to evaluate.
+        """
+        resp = get_eval_results(
+            vacation_info, TravelPlan.model_validate(travel_plan), DETERMINISTIC_EVAL_FUNCTIONS
+        )
+        return {"success": resp.success, "failures": resp.failures}
+
+    def final_answer_tool(final_output: TravelPlan) -> TravelPlan:
+        """Returns the final travel plan.
+
+        Args:
+            final_output (TravelPlan): The final travel plan.
+        """
+        return final_output
+
+    tools = [get_activities_by_date_tool, run_evals_tool, final_answer_tool]
+    executor = ToolExecutor(tools, pure_tools=[get_activities_by_date_tool, run_evals_tool])
+    agent = ChatAgent(
+        name="BenchmarkRevisionAgent",
+        system_prompt="You are the Itinerary Revision Agent. Use the tools to revise the itinerary.",
+        client=client,
+        model=model,
+    )
+    agent.add_message("user", f"Here is the itinerary for revision:\n{travel_plan.model_dump_json()}")
+    try:
+        for _ in range(max_steps):
+            message = agent.get_tool_response(tools=tools, tool_choice="required")
+            tool_calls = message.get("tool_calls") or []
+            for tool_call in tool_calls:
+                if tool_call["function"]["name"] == "final_answer_tool":
+                    arguments = json.loads(tool_call["function"]["arguments"])
+                    return TravelPlan.model_validate(arguments["final_output"])
+
+            outcomes = executor.call_many(
+                [
+                    (tool_call["function"]["name"], json.loads(tool_call["function"]["arguments"]))
+                    for tool_call in tool_calls
+                ]
+            )
+            for tool_call, (response, error) in zip(tool_calls, outcomes):
+                agent.add_message(
+                    "tool",
+                    f"OBSERVATION: {response if error is None else error}",
+                    tool_call_id=tool_call["id"],
+                )
+    finally:
+        executor.close()
+    raise RuntimeError(f"The revision did not finish within {max_steps} steps")
+
+
+def run_evals_trip(client, vacation_info, travel_plan):
+    """Evaluates one plan with the deterministic evals and the LLM weather eval."""
+    from test import (
+        DETERMINISTIC_EVAL_FUNCTIONS,
+        EvalCostTier,
+        eval_activities_and_weather_are_compatible,
+        eval_itinerary_events_match_actual_events,
+        eval_spec,
+        get_eval_results,
+    )
+
+    @eval_spec(EvalCostTier.LLM, depends_on=[eval_itinerary_events_match_actual_events])
+    def eval_weather(vacation_info, final_output):
+        # Without the rules every (activity, weather) pair costs a model call
+        eval_activities_and_weather_are_compatible(
+            vacation_info,
+            final_output,
+            content_prompt=WEATHER_VERDICT_PROMPT,
+            client=client,
+            use_rules=False,
+        )
+
+    return get_eval_results(
+        vacation_info, travel_plan, DETERMINISTIC_EVAL_FUNCTIONS + [eval_weather], parallel=True
+    )
+
+
+def percentile(values, q) -> float:
+    """Returns the q-th percentile (0-100) of values by the nearest-rank method."""
+    import math
+
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def run_scenario(name, run_trip, server, trips=20, concurrency=4) -> dict:
+    """Runs run_trip `trips` times on `concurrency` threads and measures it.
+
+    The agents' printed output is discarded while the scenario runs.
+
+    Returns:
+        dict: trips, failures, throughput, p50/p95/p99 trip latency and the requests,
+        injected errors and tokens per trip.
+    """
+    server.reset_stats()
+    latencies = []
+    failures = []
+
+    def timed_trip(_):
+        start = time.perf_counter()
+        try:
+            run_trip()
+        except Exception as e:
+            failures.append(f"{type(e).__name__}: {e}")
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed_trip, range(trips)))
+    duration = time.perf_counter() - start
+
+    stats = server.stats()
+    return {
+        "scenario": name,
+        "trips": trips,
+        "concurrency": concurrency,
+        "failures": len(failures),
+        "failure_examples": failures[:3],
+        "duration_s": duration,
+        "throughput_trips_per_s": len(latencies) / duration if duration else 0.0,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "requests_per_trip": stats["requests"] / trips,
+        "injected_errors": stats["errors"],
+        "prompt_tokens_per_trip": stats["prompt_tokens"] / trips,
+        "completion_tokens_per_trip": stats["completion_tokens"] / trips,
+        "tokens_per_trip": (stats["prompt_tokens"] + stats["completion_tokens"]) / trips,
+    }
+
+
+SCENARIOS = ("itinerary", "revision", "evals")
+
+
+def run_benchmark(
+    scenarios=SCENARIOS,
+    trips=20,
+    concurrency=4,
+    latency=None,
+    tokens_per_second=None,
+    error_rate=0.0,
+    retry_after=None,
+    stream=False,
+    seed=0,
+) -> list[dict]:
+    """Starts a fake server and runs the scenarios against it, one after the other.
+
+    Every scenario gets a fresh CompletionScheduler, so circuit breaker state and rate
+    limits do not carry over between scenarios.
+
+    Args:
+        scenarios (tuple): The scenarios to run, from SCENARIOS.
+        trips (int): The trips per scenario.
+        concurrency (int): The trips in flight at once.
+        latency (callable, optional): The fake server's latency sampler.
+        tokens_per_second (float, optional): The fake server's completion token rate.
+        error_rate (float): The share of requests answered with an injected error.
+        retry_after (float, optional): The Retry-After of injected errors, in seconds.
+        stream (bool): Whether the itinerary scenario streams its responses.
+        seed (int): Seeds the fake server's draws.
+
+    Returns:
+        list[dict]: The run_scenario results.
+    """
+    from planner import solve_itinerary
+    from utils import CompletionScheduler, get_openai_client, set_completion_scheduler
+
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {sorted(unknown)}")
+
+    vacation_info = VacationInfo.model_validate(BENCHMARK_VACATION_INFO)
+    travel_plan = solve_itinerary(vacation_info)
+    trips_by_scenario = {
+        "itinerary": lambda client: run_itinerary_trip(client, vacation_info, stream=stream),
+        "revision": lambda client: run_revision_trip(client, vacation_info, travel_plan),
+        "evals": lambda client: run_evals_trip(client, vacation_info, travel_plan),
+    }
+
+    results = []
+    with FakeOpenAIServer(
+        make_trip_planner_responder(travel_plan),
+        latency=latency,
+        tokens_per_second=tokens_per_second,
+        error_rate=error_rate,
+        retry_after=retry_after,
+        seed=seed,
+    ) as server:
+        client = get_openai_client(base_url=server.url, api_key="benchmark")
+        try:
+            for name in scenarios:
+                set_completion_scheduler(CompletionScheduler(base_delay=0.05, max_delay=1.0))
+                run_trip = trips_by_scenario[name]
+                results.append(
+                    run_scenario(name, lambda: run_trip(client), server, trips, concurrency)
+                )
+        finally:
+            set_completion_scheduler(None)
+    return results
+
+
+# Metrics compared against a baseline, and whether higher values are better
+BASELINE_METRICS = {
+    "throughput_trips_per_s": True,
+    "latency_p50_s": False,
+    "latency_p95_s": False,
+    "latency_p99_s": False,
+    "tokens_per_trip": False,
+    "requests_per_trip": False,
+}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2) -> list[str]:
+    """Lists the metrics that got worse than the baseline by more than `tolerance`.
+
+    A scenario run with other trips or concurrency than its baseline is reported as not
+    comparable, which fails the comparison too.
+
+    Args:
+        results (list[dict]): The results of run_benchmark.
+        baseline (list[dict]): Earlier results, e.g. loaded from --output.
+        tolerance (float): The relative change allowed, 0.2 being 20%.
+
+    Returns:
+        list[str]: One message per regression.
+    """
+    baseline_by_scenario = {result["scenario"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_scenario.get(result["scenario"])
+        if previous is None:
+            continue
+        # Throughput and latency depend on the load, so only like runs are compared
+        if (previous.get("trips"), previous.get("concurrency")) != (result["trips"], result["concurrency"]):
+            regressions.append(
+                f"{result['scenario']}: not comparable, the baseline ran {previous.get('trips')} trips "
+                f"at concurrency {previous.get('concurrency')}"
+            )
+            continue
+        for metric, higher_is_better in BASELINE_METRICS.items():
+            before, after = previous.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{result['scenario']}: {metric} went from {before:.4g} to {after:.4g} ({change:+.0%})"
+                )
+        if result["failures"] > previous.get("failures", 0):
+            regressions.append(
+                f"{result['scenario']}: failures went from {previous.get('failures', 0)} to {result['failures']}"
+            )
+    return regressions
+
+
+def format_results(results) -> str:
+    """Formats the results as a table."""
+    header = (
+        f"{'scenario':<10} {'trips':>5} {'fail':>4} {'trips/s':>8} {'p50 s':>7} {'p95 s':>7} "
+        f"{'p99 s':>7} {'req/trip':>8} {'errors':>6} {'tokens/trip':>11}"
+    )
+    lines = [header, "-" * len(header)]
+    for result in results:
+        lines.append(
+            f"{result['scenario']:<10} {result['trips']:>5} {result['failures']:>4} "
+            f"{result['throughput_trips_per_s']:>8.2f} {result['latency_p50_s']:>7.3f} "
+            f"{result['latency_p95_s']:>7.3f} {result['latency_p99_s']:>7.3f} "
+            f"{result['requests_per_trip']:>8.1f} {result['injected_errors']:>6} "
+            f"{result['tokens_per_trip']:>11.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--trips", type=int, default=20, help="Trips per scenario.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Trips in flight at once.")
+    parser.add_argument(
+        "--latency",
+        default="lognormal:0.05:0.5",
+        help="constant:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA (seconds to first token).",
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=2000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None, help="Seconds, sent with injected errors.")
+    parser.add_argument("--stream", action="store_true", help="Stream the itinerary responses.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare with the JSON results of an earlier run.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        scenarios=args.scenarios,
+        trips=args.trips,
+        concurrency=args.concurrency,
+        latency=parse_latency(args.latency),
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        stream=args.stream,
+        seed=args.seed,
+    )
+    print(format_results(results))
+    for result in results:
+        for example in result["failure_examples"]:
+            print(f"{result['scenario']} failure: {example}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
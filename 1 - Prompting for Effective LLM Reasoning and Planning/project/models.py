@@ -1,8 +1,8 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, PrivateAttr
+from typing import List, Literal, Optional
 import datetime
 from enum import Enum
-from utils import Interest
+from utils import Interest, interests_to_mask
 
 
 class Traveler(BaseModel):
@@ -12,11 +12,23 @@ class Traveler(BaseModel):
         name (str): The name of the traveler.
         age (int): The age of the traveler.
         interests (List[Interest]): A list of interests of the traveler.
+        interest_mask (int): The interests as a bitmask (see utils.interests_to_mask),
+            computed when the model is created.
     """
     name: str
     age: int
     interests: List[Interest]
 
+    # A private attribute, so it is neither serialized nor compared by ==
+    _interest_mask: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context):
+        self._interest_mask = interests_to_mask(self.interests)
+
+    @property
+    def interest_mask(self) -> int:
+        return self._interest_mask
+
 class VacationInfo(BaseModel):
     """Vacation information including travelers, destination, dates, and budget.
     Attributes:
@@ -48,6 +60,16 @@ class Activity(BaseModel):
     price: int
     related_interests: List[Interest]
 
+    _interest_mask: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context):
+        self._interest_mask = interests_to_mask(self.related_interests)
+
+    @property
+    def interest_mask(self) -> int:
+        """related_interests as a bitmask (see utils.interests_to_mask), computed when the model is created."""
+        return self._interest_mask
+
 
 class ActivityRecommendation(BaseModel):
     activity: Activity
@@ -67,7 +89,30 @@ class TravelPlan(BaseModel):
     total_cost: int
     itinerary_days: List[ItineraryDay]
 
+class WeatherCompatibilityVerdict(BaseModel):
+    pair_id: int
+    reasoning: str
+    verdict: Literal["IS_COMPATIBLE", "IS_INCOMPATIBLE"]
+
+
+class WeatherCompatibilityVerdicts(BaseModel):
+    verdicts: List[WeatherCompatibilityVerdict]
+
+
+class ActivityReasons(BaseModel):
+    activity_id: str
+    reasons_for_recommendation: List[str]
+
+
+class RecommendationReasons(BaseModel):
+    activities: List[ActivityReasons]
+
+
 class EvaluationResults(BaseModel):
     success: bool
     failures: List[str]
-    eval_functions: List[str]
\ No newline at end of file
+    eval_functions: List[str]
+    # Wall-clock seconds spent in each eval, in the same order as eval_functions (None if skipped)
+    eval_durations: List[Optional[float]] = []
+    # Evals that fail_fast skipped, after a cheaper eval or a dependency failed
+    skipped: List[str] = []
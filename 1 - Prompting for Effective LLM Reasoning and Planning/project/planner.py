@@ -0,0 +1,426 @@
+"""Provides a deterministic itinerary solver and speculative generation for the LLM planner."""
+
+import asyncio
+import bisect
+import datetime
+
+from models import (
+    Activity,
+    ActivityRecommendation,
+    EvaluationResults,
+    ItineraryDay,
+    RecommendationReasons,
+    TravelPlan,
+    VacationInfo,
+    Weather,
+)
+from utils import OpenAIModel, mask_to_interests
+
+
+def solve_itinerary(
+    vacation_info: VacationInfo,
+    activities_by_date: dict | None = None,
+    weather_by_date: dict | None = None,
+    min_activities_per_day: int = 1,
+    max_activities_per_day: int | None = None,
+    allow_uncertain_weather: bool = False,
+) -> TravelPlan:
+    """Builds the itinerary that best covers the travelers' interests within the budget.
+
+    Each day gets a set of non-overlapping activities that suit its weather, and the days
+    are combined by dynamic programming over (money spent, travelers covered). Plans are
+    ranked by, in order:
+
+    1. the number of travelers with at least one activity matching their interests,
+    2. the number of (traveler, activity) interest matches,
+    3. the lower total cost.
+
+    Weather suitability is decided by the rules of `test.apply_weather_rules`. Activities
+    the rules cannot decide in inclement weather are left out unless
+    `allow_uncertain_weather` is set.
+
+    Args:
+        vacation_info (VacationInfo): The travelers, destination, dates and budget.
+        activities_by_date (dict, optional): Candidate activities (dicts or Activity) per
+            date (YYYY-MM-DD). Defaults to the activity catalog of the destination.
+        weather_by_date (dict, optional): The forecast (dict or Weather) per date.
+            Defaults to the weather forecast store.
+        min_activities_per_day (int): The fewest activities a day may have.
+        max_activities_per_day (int, optional): The most activities a day may have.
+        allow_uncertain_weather (bool): Whether activities the weather rules cannot decide
+            may be scheduled in inclement weather.
+
+    Returns:
+        TravelPlan: The plan. Its reasons_for_recommendation list the matched interests;
+        use `write_recommendation_reasons` to have a model phrase them.
+
+    Raises:
+        ValueError: If a date has no forecast, or no plan fits the budget while giving
+            every day at least min_activities_per_day activities.
+    """
+    dates = _get_trip_dates(vacation_info)
+    activities_by_date = activities_by_date or _get_catalog_activities(vacation_info, dates)
+    weather_by_date = weather_by_date or _get_forecasts(vacation_info, dates)
+
+    travelers = vacation_info.travelers
+    weather_for_dates = {}
+    options_for_dates = {}
+    for date in dates:
+        weather = weather_by_date.get(date)
+        if not weather:
+            raise ValueError(f"No weather forecast for {date}.")
+        weather = weather_for_dates[date] = Weather.model_validate(weather)
+
+        candidates = [
+            activity
+            for activity in map(_to_activity, activities_by_date.get(date, []))
+            if _suits_weather(activity, weather.condition, allow_uncertain_weather)
+        ]
+        options_for_dates[date] = _get_day_options(
+            candidates, travelers, min_activities_per_day, max_activities_per_day
+        )
+
+    # Every state maps the set of covered travelers (a bitmask) to its Pareto frontier of
+    # (spent, interest matches, chosen option per day): the cheapest way to reach each
+    # number of matches, so dominated partial plans are dropped after every day.
+    states = {0: [(0, 0, ())]}
+    for date in dates:
+        next_states = {}
+        for covered, frontier in states.items():
+            for spent, matches, choices in frontier:
+                for option_index, (cost, option_covered, option_matches, _) in enumerate(
+                    options_for_dates[date]
+                ):
+                    if spent + cost > vacation_info.budget:
+                        continue
+                    next_states.setdefault(covered | option_covered, []).append(
+                        (spent + cost, matches + option_matches, choices + (option_index,))
+                    )
+        states = {
+            covered: _pareto_frontier(frontier) for covered, frontier in next_states.items()
+        }
+        if not states:
+            raise ValueError(
+                f"No itinerary within the budget of {vacation_info.budget} has at least "
+                f"{min_activities_per_day} suitable activities per day (failed on {date})."
+            )
+
+    spent, _, choices, _ = max(
+        (
+            (spent, matches, choices, (covered.bit_count(), matches, -spent))
+            for covered, frontier in states.items()
+            for spent, matches, choices in frontier
+        ),
+        key=lambda state: state[3],
+    )
+
+    itinerary_days = []
+    for date, option_index in zip(dates, choices):
+        chosen_activities = options_for_dates[date][option_index][3]
+        itinerary_days.append(
+            ItineraryDay(
+                date=date,
+                weather=weather_for_dates[date],
+                activity_recommendations=[
+                    ActivityRecommendation(
+                        activity=activity,
+                        reasons_for_recommendation=_get_default_reasons(activity, travelers),
+                    )
+                    for activity in chosen_activities
+                ],
+            )
+        )
+
+    return TravelPlan(
+        city=vacation_info.destination,
+        start_date=vacation_info.date_of_arrival,
+        end_date=vacation_info.date_of_departure,
+        total_cost=spent,
+        itinerary_days=itinerary_days,
+    )
+
+
+def _get_trip_dates(vacation_info):
+    days = (vacation_info.date_of_departure - vacation_info.date_of_arrival).days
+    return [
+        (vacation_info.date_of_arrival + datetime.timedelta(days=offset)).isoformat()
+        for offset in range(days + 1)
+    ]
+
+
+def _get_catalog_activities(vacation_info, dates):
+    from utils import get_activity_catalog
+
+    catalog = get_activity_catalog()
+    return {
+        date: [
+            catalog.get_model(activity["activity_id"])
+            for activity in catalog.get_by_date(date, vacation_info.destination)
+        ]
+        for date in dates
+    }
+
+
+def _get_forecasts(vacation_info, dates):
+    from utils import get_weather_forecast_store
+
+    store = get_weather_forecast_store()
+    return {date: store.get(vacation_info.destination, date) for date in dates}
+
+
+def _to_activity(activity):
+    return activity if isinstance(activity, Activity) else Activity.model_validate(activity)
+
+
+def _suits_weather(activity, weather_condition, allow_uncertain_weather):
+    from test import apply_weather_rules
+
+    verdict = apply_weather_rules(activity, weather_condition)
+    return verdict or (verdict is None and allow_uncertain_weather)
+
+
+def _get_day_options(activities, travelers, min_activities, max_activities):
+    """Returns every useful set of non-overlapping activities for one day.
+
+    Instead of listing every subset, the activities are taken in order of their end time,
+    as in weighted interval scheduling: the sets using the first i activities are those
+    using the first i - 1, plus activity i added to any set of the activities that end
+    before it starts. Sets with the same activity count and covered travelers are pruned
+    to their cost/matches Pareto frontier after every step, so the work grows with the
+    number of activities rather than the number of subsets.
+
+    Returns:
+        list[tuple]: (cost, covered travelers bitmask, interest matches, activities) per
+        option. For each bitmask only the options on its cost/matches Pareto frontier are kept.
+    """
+    scored = sorted(
+        ((activity, *_score_activity(activity, travelers)) for activity in activities),
+        key=lambda entry: entry[0].end_time,
+    )
+    end_times = [activity.end_time for activity, _, _ in scored]
+
+    def count_key(count):
+        # Without an upper bound, set sizes past the lower bound need not be told apart
+        return count if max_activities is not None else min(count, min_activities)
+
+    # sets_by_prefix[i] maps (activity count, covered) to the frontier of
+    # (cost, matches, activities) among the sets made of the first i activities
+    sets_by_prefix = [{(count_key(0), 0): [(0, 0, ())]}]
+    for index, (activity, activity_covered, activity_matches) in enumerate(scored):
+        sets = {key: list(frontier) for key, frontier in sets_by_prefix[-1].items()}
+        compatible = sets_by_prefix[bisect.bisect_right(end_times, activity.start_time, 0, index)]
+        for (count, covered), frontier in compatible.items():
+            if max_activities is not None and count >= max_activities:
+                continue
+            key = (count_key(count + 1), covered | activity_covered)
+            sets.setdefault(key, []).extend(
+                (cost + activity.price, matches + activity_matches, chosen + (activity,))
+                for cost, matches, chosen in frontier
+            )
+        sets_by_prefix.append(
+            {key: _pareto_frontier(frontier) for key, frontier in sets.items()}
+        )
+
+    options_by_covered = {}
+    for (count, covered), frontier in sets_by_prefix[-1].items():
+        if count >= min_activities:
+            options_by_covered.setdefault(covered, []).extend(frontier)
+
+    return [
+        (cost, covered, matches, chosen)
+        for covered, options in options_by_covered.items()
+        for cost, matches, chosen in _pareto_frontier(options)
+    ]
+
+
+def _score_activity(activity, travelers):
+    """Returns the bitmask of travelers the activity interests, and how many of them it does."""
+    covered = 0
+    for traveler_index, traveler in enumerate(travelers):
+        if activity.interest_mask & traveler.interest_mask:
+            covered |= 1 << traveler_index
+    return covered, covered.bit_count()
+
+
+def _pareto_frontier(entries):
+    """Keeps the (cost, matches, ...) entries not beaten by a cheaper entry with as many matches."""
+    frontier = []
+    best_matches = -1
+    for entry in sorted(entries, key=lambda entry: (entry[0], -entry[1])):
+        if entry[1] > best_matches:
+            frontier.append(entry)
+            best_matches = entry[1]
+    return frontier
+
+
+def _get_default_reasons(activity, travelers):
+    reasons = []
+    for traveler in travelers:
+        matching_mask = activity.interest_mask & traveler.interest_mask
+        if matching_mask:
+            reasons.append(
+                f"Matches {traveler.name}'s interest in "
+                + ", ".join(sorted(interest.value for interest in mask_to_interests(matching_mask)))
+            )
+    return reasons or ["Fits the schedule, weather and budget."]
+
+
+def write_recommendation_reasons(
+    travel_plan: TravelPlan,
+    vacation_info: VacationInfo,
+    model=OpenAIModel.GPT_41_MINI,
+    client=None,
+) -> TravelPlan:
+    """Asks a model to phrase the reasons for each activity of a solved plan.
+
+    The activities, dates and costs stay as the solver chose them; only
+    reasons_for_recommendation is replaced. Activities the response leaves out keep
+    their default reasons.
+
+    Args:
+        travel_plan (TravelPlan): A plan, e.g. from solve_itinerary.
+        vacation_info (VacationInfo): The travelers the reasons are written for.
+        model (OpenAIModel): The model to use.
+        client (OpenAI, optional): The client. Defaults to the shared client of
+            utils.get_openai_client.
+
+    Returns:
+        TravelPlan: A copy of travel_plan with the new reasons.
+    """
+    from utils import do_chat_completion
+
+    activities = [
+        activity_recommendation.activity
+        for itinerary_day in travel_plan.itinerary_days
+        for activity_recommendation in itinerary_day.activity_recommendations
+    ]
+    resp = do_chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You write short, friendly reasons why each activity of a travel itinerary "
+                    "was recommended to the travelers. Refer to the travelers by name and to "
+                    "their interests. Give one to three reasons per activity_id."
+                ),
+            },
+            {
+                "role": "user",
+                "content": f"Travelers: {vacation_info.model_dump_json(include={'travelers'})}\n\n"
+                + "\n\n".join(
+                    f"activity_id: {activity.activity_id}\nName: {activity.name}\n"
+                    f"Description: {activity.description}\n"
+                    f"Related interests: {', '.join(interest.value for interest in activity.related_interests)}"
+                    for activity in activities
+                ),
+            },
+        ],
+        model=model,
+        client=client,
+        response_format=RecommendationReasons,
+    )
+    reasons_by_id = {
+        activity_reasons.activity_id: activity_reasons.reasons_for_recommendation
+        for activity_reasons in RecommendationReasons.model_validate_json(resp or '{"activities": []}').activities
+        if activity_reasons.reasons_for_recommendation
+    }
+
+    travel_plan = travel_plan.model_copy(deep=True)
+    for itinerary_day in travel_plan.itinerary_days:
+        for activity_recommendation in itinerary_day.activity_recommendations:
+            reasons = reasons_by_id.get(activity_recommendation.activity.activity_id)
+            if reasons:
+                activity_recommendation.reasons_for_recommendation = reasons
+    return travel_plan
+
+
+# (model, temperature) pairs tried at once by generate_itinerary_speculatively
+SPECULATIVE_CANDIDATES = (
+    (OpenAIModel.GPT_41_MINI, 0.2),
+    (OpenAIModel.GPT_41_MINI, 0.8),
+    (OpenAIModel.GPT_41, 0.2),
+)
+
+
+async def generate_itinerary_speculatively(
+    messages,
+    vacation_info: VacationInfo,
+    candidates=SPECULATIVE_CANDIDATES,
+    eval_functions=None,
+    client=None,
+    **kwargs,
+) -> tuple[TravelPlan, EvaluationResults]:
+    """Generates itineraries with several models and temperatures at once and keeps the first good one.
+
+    Every candidate request is started concurrently. Responses are parsed and checked with
+    the deterministic evals as they arrive, and the first plan that passes them all is
+    returned while the requests still running are cancelled. This spends extra tokens in
+    parallel to cut the tail latency of a failed plan followed by a serial revision.
+
+    If no plan passes, the one with the fewest failures is returned once every candidate
+    has answered, so it can be handed to the revision agent.
+
+    Args:
+        messages (list[dict]): The itinerary request, e.g. an ItineraryAgent's system
+            messages followed by the vacation info as the user message.
+        vacation_info (VacationInfo): The vacation information the plans are checked against.
+        candidates (list[tuple]): (model, temperature) per request. A temperature of None
+            keeps the model's default.
+        eval_functions (list[callable], optional): The checks a plan must pass. Defaults to
+            test.DETERMINISTIC_EVAL_FUNCTIONS.
+        client (AsyncOpenAI, optional): The client. Defaults to the shared async client of
+            utils.get_openai_client.
+        **kwargs: Passed on to `ado_chat_completion`.
+
+    Returns:
+        tuple: The chosen TravelPlan and its EvaluationResults.
+
+    Raises:
+        ValueError: If no candidate produced a valid TravelPlan.
+    """
+    from test import DETERMINISTIC_EVAL_FUNCTIONS, get_eval_results
+    from utils import ado_chat_completion, parse_travel_plan_stream
+
+    eval_functions = list(eval_functions or DETERMINISTIC_EVAL_FUNCTIONS)
+
+    async def generate(model, temperature):
+        temperature_kwargs = {} if temperature is None else {"temperature": temperature}
+        response = await ado_chat_completion(
+            messages, model=model, client=client, **temperature_kwargs, **kwargs
+        )
+        return model, temperature, response
+
+    tasks = [
+        asyncio.ensure_future(generate(model, temperature)) for model, temperature in candidates
+    ]
+    best = None
+    errors = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                model, temperature, response = await next_done
+                travel_plan, _ = parse_travel_plan_stream([response or ""])
+            except Exception as e:
+                # A failed or malformed candidate leaves the others to answer
+                errors.append(e)
+                continue
+
+            eval_results = get_eval_results(vacation_info, travel_plan, eval_functions)
+            if eval_results.success:
+                print(
+                    f"Candidate {getattr(model, 'value', model)} (temperature {temperature}) "
+                    "passed the checks."
+                )
+                return travel_plan, eval_results
+            if best is None or len(eval_results.failures) < len(best[1].failures):
+                best = (travel_plan, eval_results)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if best is None:
+        raise ValueError(
+            f"None of the {len(tasks)} candidates produced a valid TravelPlan: {errors}"
+        )
+    return best
@@ -1,20 +1,93 @@
-from openai import OpenAI
-from models import Activity, EvaluationResults, VacationInfo, TravelPlan, Activity
+import re
+import threading
+from enum import IntEnum
+
+from openai import ContentFilterFinishReasonError, LengthFinishReasonError, OpenAI
+from pydantic import ValidationError
+from models import (
+    Activity,
+    EvaluationResults,
+    VacationInfo,
+    TravelPlan,
+    WeatherCompatibilityVerdicts,
+)
+from utils import INCLIMATE_WEATHER_CONDITIONS, OpenAIModel
 
 
 class AgentError(Exception):
     pass
 
 
-def get_eval_results(vacation_info, final_output, eval_functions) -> EvaluationResults:
+class EvalCostTier(IntEnum):
+    """How expensive an evaluation function is to run. Cheaper tiers run first."""
+
+    DETERMINISTIC = 0
+    LLM = 1
+
+
+def eval_spec(
+    cost_tier: EvalCostTier = EvalCostTier.DETERMINISTIC, depends_on=(), per_activity=False
+):
+    """Declares the cost tier of an evaluation function and the evals it depends on.
+
+    get_eval_results runs the evals tier by tier and every eval after its dependencies. With
+    fail_fast, it skips an eval when one of its dependencies failed or was skipped.
+    Evaluation functions without a spec are assumed to be LLM-backed and to have no
+    dependencies.
+
+    Args:
+        cost_tier (EvalCostTier): The cost tier of the function.
+        depends_on (iterable): The evaluation functions (or their names) that must pass
+            before this one is worth running.
+        per_activity (bool): Whether the eval checks every activity on its own, so that a
+            plan passes exactly when each of its (day, activity) items would pass alone.
+            IncrementalPlanEvaluator re-runs such evals only for changed items.
+
+    Returns:
+        callable: A decorator that records the spec on the function and returns it unchanged.
+    """
+    dependency_names = tuple(
+        dependency if isinstance(dependency, str) else dependency.__name__
+        for dependency in depends_on
+    )
+
+    def decorator(eval_fn):
+        eval_fn.eval_cost_tier = EvalCostTier(cost_tier)
+        eval_fn.eval_depends_on = dependency_names
+        eval_fn.eval_per_activity = per_activity
+        return eval_fn
+
+    return decorator
+
+
+def get_eval_results(
+    vacation_info,
+    final_output,
+    eval_functions,
+    parallel=False,
+    max_workers=None,
+    fail_fast=False,
+) -> EvaluationResults:
     """
     Evaluates the final output of the itinerary agent against a set of evaluation functions.
     Args:
         vacation_info (VacationInfo): The vacation information used to generate the itinerary.
         final_output (TravelPlan): The final output from the itinerary agent.
         eval_functions (List[callable]): A list of evaluation functions to apply.
+        parallel (bool): Whether to run the evaluation functions concurrently in a thread pool.
+            The LLM-backed evals spend most of their time waiting on the network, so this
+            mostly saves wall-clock time. Failures are still reported in the order of
+            eval_functions.
+        max_workers (int, optional): The size of the thread pool when parallel is True.
+            Defaults to one thread per evaluation function.
+        fail_fast (bool): Whether to skip the LLM-backed evals once a cheaper eval has
+            failed, and every eval whose dependency failed, since the plan has to be
+            revised anyway. Without it every eval runs, so all failures are reported.
     Returns:
-        EvaluationResults: An object containing the success status, any failures, and the names of the evaluation functions used.
+        EvaluationResults: An object containing the success status, any failures, the names of the evaluation functions used, how long each one took (None for skipped ones) and which ones were skipped.
+
+    The evals run in stages: cheap deterministic checks first (see eval_spec), and every
+    eval after the evals it depends on.
     """
     from utils import print_in_box
     if not isinstance(vacation_info, VacationInfo):
@@ -25,12 +98,44 @@ def get_eval_results(vacation_info, final_output, eval_functions) -> EvaluationR
         callable(fn) for fn in eval_functions
     ):
         raise ValueError("eval_functions must be a list of callable functions")
+
+    executor = None
+    if parallel and eval_functions:
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(eval_functions))
+
+    outcomes = [(None, None)] * len(eval_functions)
+    failed_names = set()
+    skipped_names = set()
+    try:
+        for stage_tier, stage in _get_eval_stages(eval_functions):
+            to_run = []
+            for index in stage:
+                eval_fn = eval_functions[index]
+                if fail_fast and (
+                    (failed_names and stage_tier > EvalCostTier.DETERMINISTIC)
+                    or (failed_names | skipped_names).intersection(_get_eval_dependencies(eval_fn))
+                ):
+                    skipped_names.add(eval_fn.__name__)
+                else:
+                    to_run.append(index)
+
+            run = lambda index: _run_eval_function(
+                eval_functions[index], vacation_info, final_output
+            )
+            stage_outcomes = list(executor.map(run, to_run)) if executor else map(run, to_run)
+            for index, outcome in zip(to_run, stage_outcomes):
+                outcomes[index] = outcome
+                if outcome[0] is not None:
+                    failed_names.add(eval_functions[index].__name__)
+    finally:
+        if executor:
+            executor.shutdown()
+
     eval_results = []
-    for eval_fn in eval_functions:
-        try:
-            eval_fn(vacation_info, final_output)
-        except AgentError as e:
-            error_msg = str(e)
+    for error_msg, _ in outcomes:
+        if error_msg is not None:
             print_in_box(error_msg, title="Evaluation Error")
             print("\n\n")
 
@@ -39,9 +144,488 @@ def get_eval_results(vacation_info, final_output, eval_functions) -> EvaluationR
         success=len(eval_results) == 0,
         failures=eval_results,
         eval_functions=[fn.__name__ for fn in eval_functions],
+        eval_durations=[duration for _, duration in outcomes],
+        skipped=[fn.__name__ for fn in eval_functions if fn.__name__ in skipped_names],
+    )
+
+
+def _get_eval_cost_tier(eval_fn):
+    return getattr(eval_fn, "eval_cost_tier", EvalCostTier.LLM)
+
+
+def _get_eval_dependencies(eval_fn):
+    return getattr(eval_fn, "eval_depends_on", ())
+
+
+def _get_eval_stages(eval_functions):
+    """Groups the evaluation functions into stages that run one after the other.
+
+    Stages are ordered by cost tier and then by dependency depth within the tier, so every
+    eval runs after the evals it depends on. An eval that depends on a more expensive one
+    moves up to that tier. Dependencies on evals that are not in eval_functions are ignored.
+
+    Returns:
+        list[tuple]: (cost tier, indices into eval_functions) per stage.
+
+    Raises:
+        ValueError: If the dependencies form a cycle.
+    """
+    indices_by_name = {}
+    for index, eval_fn in enumerate(eval_functions):
+        indices_by_name.setdefault(eval_fn.__name__, []).append(index)
+
+    stage_keys = {}
+
+    def get_stage_key(index, visiting):
+        if index in stage_keys:
+            return stage_keys[index]
+        eval_fn = eval_functions[index]
+        if index in visiting:
+            raise ValueError(f"The dependencies of {eval_fn.__name__} form a cycle")
+        visiting.add(index)
+        dependency_keys = [
+            get_stage_key(dependency_index, visiting)
+            for dependency_name in _get_eval_dependencies(eval_fn)
+            for dependency_index in indices_by_name.get(dependency_name, [])
+        ]
+        visiting.discard(index)
+        tier = max([_get_eval_cost_tier(eval_fn), *(key[0] for key in dependency_keys)])
+        # Only dependencies in the same tier need a later stage within it
+        depth = max([0, *(key[1] + 1 for key in dependency_keys if key[0] == tier)])
+        stage_keys[index] = (tier, depth)
+        return stage_keys[index]
+
+    stages = {}
+    for index in range(len(eval_functions)):
+        stages.setdefault(get_stage_key(index, set()), []).append(index)
+    return [(key[0], stages[key]) for key in sorted(stages)]
+
+
+def _run_eval_function(eval_fn, vacation_info, final_output):
+    """Runs a single evaluation function.
+
+    Completion calls made by the eval are attributed to it in the instrumentation hooks.
+
+    Returns:
+        tuple: The AgentError message (or None if the eval passed) and the elapsed seconds.
+    """
+    import time
+
+    from utils import eval_context
+
+    start = time.perf_counter()
+    try:
+        with eval_context(eval_fn.__name__):
+            eval_fn(vacation_info, final_output)
+        error_msg = None
+    except AgentError as e:
+        error_msg = str(e)
+    return error_msg, time.perf_counter() - start
+
+
+class IncrementalPlanEvaluator:
+    """Re-evaluates revised travel plans, re-running per-activity checks only for changed items.
+
+    The results of per-activity evals (see eval_spec) are cached per (day, activity) item,
+    keyed on the activity and the day's date and weather. Evaluating a revision runs such
+    an eval once, on a sub-plan made of the items without a cached result, so batching
+    evals (like the weather eval) still judge them together. The other evals, which look
+    at the plan as a whole, are cheap and always run. The reasons for recommendation are
+    not part of an item, so rewording them re-runs nothing.
+
+    When the sub-plan fails, its message is reported as is. To know which items to cache
+    as failed, the failing sub-plan is split in halves and the halves are evaluated again
+    until every failing item stands alone, which takes far fewer runs than one per item
+    when only a few items fail.
+
+    The evals still go through get_eval_results, so stages, dependencies and fail_fast
+    behave as usual.
+
+    Args:
+        vacation_info (VacationInfo): The vacation information every plan is evaluated against.
+        max_workers (int, optional): The size of the thread pool the halves of a failing
+            sub-plan are evaluated in. Defaults to one thread per half.
+
+    Attributes:
+        last_diff (dict): How the last evaluated plan differed from the one before it:
+            days_added, days_removed, days_changed, items_changed and items_unchanged.
+        stats (dict): Running totals of evaluations, items_evaluated, items_reused and
+            eval_runs (calls of per-activity evals).
+    """
+
+    def __init__(self, vacation_info: VacationInfo, max_workers=None):
+        if not isinstance(vacation_info, VacationInfo):
+            raise ValueError("vacation_info must be an instance of VacationInfo")
+        self.vacation_info = vacation_info
+        self.max_workers = max_workers
+        self.last_diff = None
+        self.stats = {"evaluations": 0, "items_evaluated": 0, "items_reused": 0, "eval_runs": 0}
+        self._previous_plan = None
+        self._results = {}
+        self._wrappers = {}
+        self._lock = threading.Lock()
+
+    def evaluate(
+        self, travel_plan: TravelPlan, eval_functions, parallel=False, fail_fast=False
+    ) -> EvaluationResults:
+        """Evaluates a plan like get_eval_results, reusing the results of unchanged items.
+
+        Args:
+            travel_plan (TravelPlan): The plan to evaluate.
+            eval_functions (List[callable]): The evaluation functions to apply.
+            parallel (bool): Passed on to get_eval_results.
+            fail_fast (bool): Passed on to get_eval_results.
+
+        Returns:
+            EvaluationResults: The results, as get_eval_results reports them.
+        """
+        if not isinstance(travel_plan, TravelPlan):
+            raise ValueError("final_output must be an instance of TravelPlan")
+        if not isinstance(eval_functions, list) or not all(
+            callable(fn) for fn in eval_functions
+        ):
+            raise ValueError("eval_functions must be a list of callable functions")
+
+        self.last_diff = _diff_travel_plans(self._previous_plan, travel_plan)
+        self._previous_plan = travel_plan
+        self.stats["evaluations"] += 1
+        return get_eval_results(
+            vacation_info=self.vacation_info,
+            final_output=travel_plan,
+            eval_functions=[self._get_incremental_eval(eval_fn) for eval_fn in eval_functions],
+            parallel=parallel,
+            fail_fast=fail_fast,
+        )
+
+    def clear(self):
+        """Forgets the cached item results, e.g. after changing an eval's prompt."""
+        with self._lock:
+            self._results.clear()
+        self._previous_plan = None
+
+    def _get_incremental_eval(self, eval_fn):
+        if not getattr(eval_fn, "eval_per_activity", False):
+            return eval_fn
+        if eval_fn not in self._wrappers:
+            import functools
+
+            @functools.wraps(eval_fn)
+            def incremental_eval(vacation_info, final_output):
+                self._run_per_activity_eval(eval_fn, final_output)
+
+            self._wrappers[eval_fn] = incremental_eval
+        return self._wrappers[eval_fn]
+
+    def _run_per_activity_eval(self, eval_fn, travel_plan):
+        """Runs eval_fn on the items without a cached result and raises for the failing ones."""
+        items = [
+            (
+                (eval_fn, *_get_plan_item_key(itinerary_day, activity_recommendation)),
+                itinerary_day,
+                activity_recommendation,
+            )
+            for itinerary_day in travel_plan.itinerary_days
+            for activity_recommendation in itinerary_day.activity_recommendations
+        ]
+        with self._lock:
+            pending = list(
+                {key: (key, itinerary_day, activity_recommendation)
+                 for key, itinerary_day, activity_recommendation in items
+                 if key not in self._results}.values()
+            )
+            self.stats["items_evaluated"] += len(pending)
+            self.stats["items_reused"] += len(items) - len(pending)
+
+        error_messages = []
+        if pending:
+            error_msg = self._run_on_items(eval_fn, travel_plan, pending)
+            if error_msg is None:
+                outcomes = {key: None for key, _, _ in pending}
+            else:
+                error_messages.append(error_msg)
+                outcomes = self._attribute_failure(eval_fn, travel_plan, pending, error_msg)
+        else:
+            outcomes = {}
+
+        pending_keys = set(outcomes)
+        with self._lock:
+            self._results.update(outcomes)
+            error_messages += [
+                self._results[key] for key, _, _ in items if key not in pending_keys
+            ]
+
+        error_messages = list(dict.fromkeys(msg for msg in error_messages if msg is not None))
+        if error_messages:
+            raise AgentError("\n".join(error_messages))
+
+    def _attribute_failure(self, eval_fn, travel_plan, items, error_msg):
+        """Finds the failing items of a failed run by splitting it in halves.
+
+        Returns:
+            dict: The error message, or None, per item key.
+        """
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+
+        outcomes = {}
+        failed_groups = [(items, error_msg)]
+        while failed_groups:
+            halves = []
+            for group, group_error_msg in failed_groups:
+                if len(group) == 1:
+                    outcomes[group[0][0]] = group_error_msg
+                else:
+                    halves += [group[: len(group) // 2], group[len(group) // 2:]]
+            if not halves:
+                break
+
+            # Each half runs in a copy of the caller's context, keeping the eval attribution
+            with ThreadPoolExecutor(max_workers=self.max_workers or len(halves)) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self._run_on_items, eval_fn, travel_plan, half,
+                    )
+                    for half in halves
+                ]
+                half_error_msgs = [future.result() for future in futures]
+
+            failed_groups = []
+            for half, half_error_msg in zip(halves, half_error_msgs):
+                if half_error_msg is None:
+                    outcomes.update((key, None) for key, _, _ in half)
+                else:
+                    failed_groups.append((half, half_error_msg))
+        return outcomes
+
+    def _run_on_items(self, eval_fn, travel_plan, items):
+        """Runs eval_fn on a copy of travel_plan holding only items, and returns its error message or None."""
+        recommendations_by_day = {}
+        for _, itinerary_day, activity_recommendation in items:
+            recommendations_by_day.setdefault(itinerary_day.date, (itinerary_day, []))[1].append(
+                activity_recommendation
+            )
+        items_plan = travel_plan.model_copy(
+            update={
+                "itinerary_days": [
+                    itinerary_day.model_copy(update={"activity_recommendations": recommendations})
+                    for itinerary_day, recommendations in recommendations_by_day.values()
+                ]
+            }
+        )
+        with self._lock:
+            self.stats["eval_runs"] += 1
+        try:
+            eval_fn(self.vacation_info, items_plan)
+        except AgentError as e:
+            return str(e)
+        return None
+
+
+def _get_plan_item_key(itinerary_day, activity_recommendation):
+    return (
+        itinerary_day.date,
+        itinerary_day.weather.model_dump_json(),
+        activity_recommendation.activity.model_dump_json(),
     )
 
 
+def _diff_travel_plans(previous_plan, travel_plan):
+    """Compares two plans day by day and, within changed days, item by item."""
+    previous_days = {
+        itinerary_day.date: itinerary_day
+        for itinerary_day in (previous_plan.itinerary_days if previous_plan else [])
+    }
+    days = {itinerary_day.date: itinerary_day for itinerary_day in travel_plan.itinerary_days}
+
+    diff = {
+        "days_added": sorted(str(date) for date in days.keys() - previous_days.keys()),
+        "days_removed": sorted(str(date) for date in previous_days.keys() - days.keys()),
+        "days_changed": [],
+        "items_changed": 0,
+        "items_unchanged": 0,
+    }
+    for date, itinerary_day in days.items():
+        item_keys = [
+            _get_plan_item_key(itinerary_day, activity_recommendation)
+            for activity_recommendation in itinerary_day.activity_recommendations
+        ]
+        previous_day = previous_days.get(date)
+        if previous_day is None:
+            diff["items_changed"] += len(item_keys)
+            continue
+        if previous_day == itinerary_day:
+            diff["items_unchanged"] += len(item_keys)
+            continue
+
+        previous_item_keys = {
+            _get_plan_item_key(previous_day, activity_recommendation)
+            for activity_recommendation in previous_day.activity_recommendations
+        }
+        changed = sum(key not in previous_item_keys for key in item_keys)
+        diff["items_changed"] += changed
+        diff["items_unchanged"] += len(item_keys) - changed
+        if changed or len(item_keys) != len(previous_item_keys):
+            diff["days_changed"].append(str(date))
+    return diff
+
+
+def get_bulk_eval_results(vacation_info, travel_plans, check_events=True) -> list[EvaluationResults]:
+    """Runs the deterministic evals over many travel plans at once.
+
+    The plans are flattened once into NumPy arrays (one row per plan, per activity and
+    per traveler) and the date, cost, budget and interest checks are computed on whole
+    arrays instead of plan by plan. They give the same verdicts and messages as
+    eval_start_end_dates_match, eval_total_cost_is_accurate,
+    eval_itinerary_events_match_actual_events, eval_itinerary_satisfies_interests and
+    eval_total_cost_is_within_budget, without printing per-activity progress.
+
+    Args:
+        vacation_info (VacationInfo | list[VacationInfo]): The vacation information, shared
+            by all plans or one per plan.
+        travel_plans (list[TravelPlan]): The plans to evaluate.
+        check_events (bool): Whether to compare every activity with the activity catalog.
+            This is the one check that is done activity by activity.
+
+    Returns:
+        list[EvaluationResults]: One result per plan, in order. eval_durations hold each
+        check's bulk time divided by the number of plans.
+    """
+    import time
+
+    import numpy as np
+
+    from utils import get_activity_catalog
+
+    plan_count = len(travel_plans)
+    if isinstance(vacation_info, VacationInfo):
+        vacation_infos = [vacation_info] * plan_count
+    else:
+        vacation_infos = list(vacation_info)
+        if len(vacation_infos) != plan_count:
+            raise ValueError("Expected one VacationInfo per travel plan.")
+
+    # Flatten the plans into columns
+    activity_plan_indexes, activity_prices, activity_masks, activities = [], [], [], []
+    for plan_index, travel_plan in enumerate(travel_plans):
+        for itinerary_day in travel_plan.itinerary_days:
+            for activity_recommendation in itinerary_day.activity_recommendations:
+                activity = activity_recommendation.activity
+                activity_plan_indexes.append(plan_index)
+                activity_prices.append(activity.price)
+                activity_masks.append(activity.interest_mask)
+                activities.append(activity)
+    activity_plan_indexes = np.array(activity_plan_indexes, dtype=np.int64)
+    activity_prices = np.array(activity_prices, dtype=np.int64)
+    activity_masks = np.array(activity_masks, dtype=np.int64)
+
+    traveler_plan_indexes, traveler_masks, traveler_names = [], [], []
+    for plan_index, plan_vacation_info in enumerate(vacation_infos):
+        for traveler in plan_vacation_info.travelers:
+            traveler_plan_indexes.append(plan_index)
+            traveler_masks.append(traveler.interest_mask)
+            traveler_names.append(traveler.name)
+    traveler_plan_indexes = np.array(traveler_plan_indexes, dtype=np.int64)
+    traveler_masks = np.array(traveler_masks, dtype=np.int64)
+
+    start_dates = np.array([plan.start_date.toordinal() for plan in travel_plans], dtype=np.int64)
+    end_dates = np.array([plan.end_date.toordinal() for plan in travel_plans], dtype=np.int64)
+    stated_costs = np.array([int(plan.total_cost) for plan in travel_plans], dtype=np.int64)
+    arrival_dates = np.array([info.date_of_arrival.toordinal() for info in vacation_infos], dtype=np.int64)
+    departure_dates = np.array([info.date_of_departure.toordinal() for info in vacation_infos], dtype=np.int64)
+    budgets = np.array([info.budget for info in vacation_infos], dtype=np.int64)
+
+    failures = [[] for _ in range(plan_count)]
+    eval_functions = []
+    eval_durations = []
+
+    def run_check(eval_fn, check):
+        start = time.perf_counter()
+        check()
+        eval_functions.append(eval_fn.__name__)
+        eval_durations.append((time.perf_counter() - start) / max(plan_count, 1))
+
+    def check_dates():
+        dates_differ = (arrival_dates != start_dates) | (departure_dates != end_dates)
+        for plan_index in np.flatnonzero(dates_differ | (start_dates > end_dates)):
+            plan, info = travel_plans[plan_index], vacation_infos[plan_index]
+            if dates_differ[plan_index]:
+                failures[plan_index].append(
+                    f"Dates do not match: {info.date_of_arrival} != {plan.start_date} or {info.date_of_departure} != {plan.end_date}"
+                )
+            else:
+                failures[plan_index].append(
+                    f"Start date is after end date: {plan.start_date} > {plan.end_date}"
+                )
+
+    def check_total_cost():
+        actual_costs = np.bincount(
+            activity_plan_indexes, weights=activity_prices, minlength=plan_count
+        ).astype(np.int64)
+        for plan_index in np.flatnonzero(actual_costs != stated_costs):
+            failures[plan_index].append(
+                f"Stated total cost does not match calculated total cost: {actual_costs[plan_index]} != {stated_costs[plan_index]}"
+            )
+
+    def check_event_ids():
+        catalog = get_activity_catalog()
+        event_ids_missing = [[] for _ in range(plan_count)]
+        event_ids_not_matching = [[] for _ in range(plan_count)]
+        for plan_index, activity in zip(activity_plan_indexes.tolist(), activities):
+            reference_activity = catalog.get_model(activity.activity_id)
+            if reference_activity is None:
+                event_ids_missing[plan_index].append(activity.activity_id)
+            elif reference_activity != activity:
+                event_ids_not_matching[plan_index].append(activity.activity_id)
+        for plan_index in range(plan_count):
+            if event_ids_missing[plan_index] or event_ids_not_matching[plan_index]:
+                failures[plan_index].append(
+                    f"Event IDs missing: {event_ids_missing[plan_index]}\nEvent IDs not matching: {event_ids_not_matching[plan_index]}"
+                )
+
+    def check_interests():
+        # A traveler matches some activity exactly when their interests overlap the union
+        # of the plan's activity interests, so one OR-reduction per plan is enough
+        plan_interest_masks = np.zeros(plan_count, dtype=np.int64)
+        np.bitwise_or.at(plan_interest_masks, activity_plan_indexes, activity_masks)
+        traveler_has_match = (plan_interest_masks[traveler_plan_indexes] & traveler_masks) != 0
+        travelers_without_match = [[] for _ in range(plan_count)]
+        for traveler_index in np.flatnonzero(~traveler_has_match):
+            travelers_without_match[traveler_plan_indexes[traveler_index]].append(
+                traveler_names[traveler_index]
+            )
+        for plan_index, traveler_names_without_match in enumerate(travelers_without_match):
+            if traveler_names_without_match:
+                failures[plan_index].append(
+                    f"Travelers {traveler_names_without_match} has no matches with the itinerary."
+                )
+
+    def check_budget():
+        for plan_index in np.flatnonzero(stated_costs > budgets):
+            failures[plan_index].append(
+                f"Total cost exceeds budget: {stated_costs[plan_index]} > {budgets[plan_index]}"
+            )
+
+    run_check(eval_start_end_dates_match, check_dates)
+    run_check(eval_total_cost_is_accurate, check_total_cost)
+    if check_events:
+        run_check(eval_itinerary_events_match_actual_events, check_event_ids)
+    run_check(eval_itinerary_satisfies_interests, check_interests)
+    run_check(eval_total_cost_is_within_budget, check_budget)
+
+    return [
+        EvaluationResults(
+            success=not plan_failures,
+            failures=plan_failures,
+            eval_functions=eval_functions,
+            eval_durations=eval_durations,
+        )
+        for plan_failures in failures
+    ]
+
+
+
+@eval_spec(EvalCostTier.DETERMINISTIC)
 def eval_start_end_dates_match(vacation_info: VacationInfo, final_output: TravelPlan):
     """Verifies that the arrival and departure dates in vacation_info match the start and end dates in final_output.
 
@@ -66,6 +650,7 @@ def eval_start_end_dates_match(vacation_info: VacationInfo, final_output: Travel
         )
 
 
+@eval_spec(EvalCostTier.DETERMINISTIC)
 def eval_total_cost_is_accurate(vacation_info: VacationInfo, final_output: TravelPlan):
     """Verifies that the total cost stated in final_output matches the sum of all activity prices.
 
@@ -90,6 +675,7 @@ def eval_total_cost_is_accurate(vacation_info: VacationInfo, final_output: Trave
         )
 
 
+@eval_spec(EvalCostTier.DETERMINISTIC)
 def eval_total_cost_is_within_budget(vacation_info: VacationInfo, final_output: TravelPlan):
     """Verifies that the total cost stated in final_output is within the budget specified in vacation_info.
 
@@ -107,6 +693,7 @@ def eval_total_cost_is_within_budget(vacation_info: VacationInfo, final_output:
         )
 
 
+@eval_spec(EvalCostTier.DETERMINISTIC, per_activity=True)
 def eval_itinerary_events_match_actual_events(
     vacation_info: VacationInfo, final_output: TravelPlan
 ):
@@ -120,25 +707,28 @@ def eval_itinerary_events_match_actual_events(
         AgentError: If any traveler has no matching activities or if one traveler has more than twice
                    the number of matching activities compared to another traveler
     """
-    from utils import call_activity_by_id_api_mocked
+    from utils import get_activity_catalog
+
+    # The catalog validates each reference event once and reuses the Activity afterwards
+    catalog = get_activity_catalog()
     event_ids_not_matching = []
     event_ids_missing = []
 
     for itinerary_day in final_output.itinerary_days:
         for activity_recommendation in itinerary_day.activity_recommendations:
             event_id = activity_recommendation.activity.activity_id
-            # Assuming get_event_by_id is a function that retrieves the event by its ID
 
-            reference_event = call_activity_by_id_api_mocked(event_id)
+            reference_activity = catalog.get_model(event_id)
 
-            if reference_event is None:
+            if reference_activity is None:
+                print(f"Event with ID {event_id} not found.")
                 event_ids_missing.append(event_id)
 
-            elif Activity(**reference_event) != activity_recommendation.activity:
+            elif reference_activity != activity_recommendation.activity:
                 print(
                     "---\n"
                     f"Event ID {event_id} does not match the reference event:\n"
-                    f"Reference Event: {reference_event}\n"
+                    f"Reference Event: {catalog.get(event_id)}\n"
                     f"Activity Event: {activity_recommendation.activity.model_dump()}"
                 )
                 event_ids_not_matching.append(event_id)
@@ -152,6 +742,7 @@ def eval_itinerary_events_match_actual_events(
         )
 
 
+@eval_spec(EvalCostTier.DETERMINISTIC)
 def eval_itinerary_satisfies_interests(
     vacation_info: VacationInfo, final_output: TravelPlan
 ):
@@ -167,25 +758,24 @@ def eval_itinerary_satisfies_interests(
         AgentError: If any traveler has no matching activities or if one traveler has more than twice
                    the number of matching activities compared to another traveler
     """
-    traveler_to_interests = {}
+    from utils import mask_to_interests
+
     traveler_to_interest_hit_counts = {}
 
     for traveler in vacation_info.travelers:
-        traveler_to_interests[traveler.name] = traveler.interests
         traveler_to_interest_hit_counts[traveler.name] = 0
 
-    for traveler_name, interests in traveler_to_interests.items():
+    for traveler in vacation_info.travelers:
         for itinerary_day in final_output.itinerary_days:
             for activity_recommendation in itinerary_day.activity_recommendations:
                 # Check if the activity matches any of the traveler's interests
-                matching_interests = set(traveler_to_interests[traveler_name]) & set(
-                    activity_recommendation.activity.related_interests
-                )
+                matching_mask = traveler.interest_mask & activity_recommendation.activity.interest_mask
 
-                if matching_interests:
-                    traveler_to_interest_hit_counts[traveler_name] += 1
+                if matching_mask:
+                    traveler_to_interest_hit_counts[traveler.name] += 1
+                    matching_interests = set(mask_to_interests(matching_mask))
                     print(
-                        f"✅ Traveler {traveler_name} has a match with interest {matching_interests} at {activity_recommendation.activity.name}"
+                        f"✅ Traveler {traveler.name} has a match with interest {matching_interests} at {activity_recommendation.activity.name}"
                     )
 
     travelers_with_no_interest_hits = [
@@ -201,66 +791,299 @@ def eval_itinerary_satisfies_interests(
         )
 
 
+# The checks that need no model call, for screening many candidate plans cheaply
+DETERMINISTIC_EVAL_FUNCTIONS = [
+    eval_start_end_dates_match,
+    eval_total_cost_is_accurate,
+    eval_itinerary_events_match_actual_events,
+    eval_itinerary_satisfies_interests,
+    eval_total_cost_is_within_budget,
+]
+
+
+# Phrases in activity descriptions that settle a weather judgment without asking a model.
+# They are matched within a single sentence (or clause after a semicolon).
+_INDOOR_PATTERN = re.compile(r"\bindoors?\b", re.IGNORECASE)
+_OUTDOOR_PATTERN = re.compile(
+    r"\b(?:outdoors?|outside|open[- ]air|open sky)\b", re.IGNORECASE
+)
+_CANCELLED_BY_WEATHER_PATTERN = re.compile(
+    r"\bcancel\w*[^.;]*\b(?:rain|storm|weather)|\b(?:rain|storm|weather)\w*[^.;]*\bcancel",
+    re.IGNORECASE,
+)
+_WEATHER_BACKUP_PATTERN = re.compile(
+    r"\b(?:in case of|if it|if there is|should it)\b[^.;]*\b(?:rain|storm|weather)\w*"
+    r"[^.;]*\b(?:move|moves|moved|relocat\w*|held)\b[^.;]*\bindoors?\b"
+    r"|\brain or shine\b"
+    r"|\b(?:backup|back-up|alternate|rain) (?:indoor )?(?:venue|location|plan)\b",
+    re.IGNORECASE,
+)
+
+# How many weather judgments the rules settled, and how many were left to a model
+WEATHER_PREFILTER_STATS = {"decided_by_rules": 0, "sent_to_model": 0}
+_WEATHER_PREFILTER_STATS_LOCK = threading.Lock()
+
+
+def classify_activity_weather_by_rules(activity: Activity, weather_condition: str) -> bool | None:
+    """Decides the obvious (activity, weather) pairs without a model.
+
+    The rules, in order:
+
+    - weather that is not in INCLIMATE_WEATHER_CONDITIONS is compatible with anything,
+    - an activity cancelled by bad weather is incompatible,
+    - an activity with a stated bad-weather backup ("in case of rain, we move indoors",
+      "rain or shine", "backup venue") is compatible,
+    - an activity described only as indoors is compatible, and one described only as
+      outdoors is incompatible.
+
+    Every call is counted in WEATHER_PREFILTER_STATS, as a decision or as a pair sent
+    on to the model.
+
+    Args:
+        activity (Activity): The activity.
+        weather_condition (str): The forecast weather condition.
+
+    Returns:
+        bool | None: True if compatible, False if incompatible, and None when the
+        description is ambiguous and a model should judge the pair.
+    """
+    verdict = apply_weather_rules(activity, weather_condition)
+    with _WEATHER_PREFILTER_STATS_LOCK:
+        if verdict is None:
+            WEATHER_PREFILTER_STATS["sent_to_model"] += 1
+        else:
+            WEATHER_PREFILTER_STATS["decided_by_rules"] += 1
+    return verdict
+
+
+def apply_weather_rules(activity: Activity, weather_condition: str) -> bool | None:
+    """The rules of classify_activity_weather_by_rules, without counting the call."""
+    if weather_condition.strip().lower() not in INCLIMATE_WEATHER_CONDITIONS:
+        return True
+
+    description = activity.description
+    if _CANCELLED_BY_WEATHER_PATTERN.search(description):
+        return False
+    if _WEATHER_BACKUP_PATTERN.search(description):
+        return True
+
+    is_indoor = _INDOOR_PATTERN.search(description) is not None
+    is_outdoor = _OUTDOOR_PATTERN.search(description) is not None
+    if is_indoor and not is_outdoor:
+        return True
+    if is_outdoor and not is_indoor:
+        return False
+    return None
+
+
+WEATHER_COMPATIBILITY_BATCH_INSTRUCTIONS = """
+## Batch Mode
+
+You will be given several numbered (activity, weather) pairs instead of a single one.
+Judge every pair independently using the guidance above, and return exactly one verdict
+per pair_id, with a short reasoning and a verdict of IS_COMPATIBLE or IS_INCOMPATIBLE.
+""".strip()
+
+
+@eval_spec(
+    EvalCostTier.LLM, depends_on=[eval_itinerary_events_match_actual_events], per_activity=True
+)
 def eval_activities_and_weather_are_compatible(
-    vacation_info: VacationInfo, final_output: TravelPlan, content_prompt: str, client: OpenAI):
+    vacation_info: VacationInfo,
+    final_output: TravelPlan,
+    content_prompt: str,
+    client: OpenAI | None = None,
+    batch_size: int | None = None,
+    cache=None,
+    cascade=None,
+    use_rules: bool = True,
+):
     """Verifies that no outdoor-only activities are scheduled during inclement weather conditions.
 
     Args:
         vacation_info (dict): Contains the vacation details
         final_output (dict): Contains the itinerary details including daily activities and weather conditions
+        content_prompt (str): The system prompt used to judge a single (activity, weather) pair.
+        client (OpenAI, optional): The OpenAI client. Defaults to the shared client of
+            utils.get_openai_client.
+        batch_size (int, optional): When set, the (activity, weather) pairs of the plan are judged
+            together in structured-output requests of up to batch_size pairs each, instead of one
+            request per pair. Pairs missing from or unparseable in a batch response are re-judged
+            one by one.
+        cache (ResponseCache, optional): A response cache, so that re-evaluating an unchanged
+            plan does not pay for the same verdicts again.
+        cascade (ModelCascade, optional): When set, single pairs are judged by the cascade,
+            starting on its cheapest tier and escalating on unparseable or inconsistent
+            verdicts, instead of always on GPT_41_NANO. Batched judgments stay on GPT_41_NANO.
+        use_rules (bool): Whether to settle the obvious pairs with classify_activity_weather_by_rules
+            first and send only the ambiguous ones to the model. The number of model calls
+            avoided is counted in WEATHER_PREFILTER_STATS["decided_by_rules"].
 
     Raises:
         AgentError: If any outdoor activities are scheduled during weather conditions that could ruin them
     """
-    from utils import do_chat_completion
-
     activities_that_are_incompatible = []
 
-    for itinerary_day in final_output.itinerary_days:
+    pairs = [
+        (itinerary_day, activity_recommendation.activity)
+        for itinerary_day in final_output.itinerary_days
+        for activity_recommendation in itinerary_day.activity_recommendations
+    ]
+
+    verdicts = [
+        classify_activity_weather_by_rules(activity, itinerary_day.weather.condition)
+        if use_rules
+        else None
+        for itinerary_day, activity in pairs
+    ]
+    undecided = [index for index, verdict in enumerate(verdicts) if verdict is None]
+
+    if batch_size and undecided:
+        batch_verdicts = _judge_activity_weather_pairs_batched(
+            [(pairs[index][1], pairs[index][0].weather.condition) for index in undecided],
+            content_prompt=content_prompt,
+            client=client,
+            batch_size=batch_size,
+            cache=cache,
+        )
+        for index, verdict in zip(undecided, batch_verdicts):
+            verdicts[index] = verdict
+
+    for (itinerary_day, activity), is_compatible in zip(pairs, verdicts):
         weather_condition = itinerary_day.weather.condition
 
-        for activity_recommendation in itinerary_day.activity_recommendations:
+        if is_compatible is None:
+            is_compatible = _judge_activity_weather_pair(
+                activity,
+                weather_condition,
+                content_prompt=content_prompt,
+                client=client,
+                cache=cache,
+                cascade=cascade,
+            )
+
+        if is_compatible:
+            print(
+                f"✅ Activity {activity.name} (on {itinerary_day.date}) and weather '{weather_condition}' are compatible."
+            )
+
+        else:
+            activities_that_are_incompatible.append(activity.name)
+            print(
+                f"❌ Activity {activity.name} (on {itinerary_day.date}) and weather '{weather_condition}' are incompatible."
+            )
+
+    if activities_that_are_incompatible:
+        raise AgentError(
+            f"Activities that may be ruined by inclement weather: {activities_that_are_incompatible}"
+        )
+
+
+def _format_activity_weather_pair(activity: Activity, weather_condition: str) -> str:
+    return f"Activity: {activity.name}\nDescription: {activity.description}\nWeather Condition: {weather_condition}"
+
+
+def _judge_activity_weather_pair(
+    activity: Activity,
+    weather_condition: str,
+    content_prompt: str,
+    client: OpenAI | None,
+    cache=None,
+    cascade=None,
+) -> bool:
+    """Asks the model whether a single activity is compatible with the weather.
+
+    Raises:
+        RuntimeError: If the response contains neither IS_COMPATIBLE nor IS_INCOMPATIBLE.
+    """
+    from utils import do_chat_completion
+
+    messages = [
+        {
+            "role": "system",
+            "content": content_prompt,
+        },
+        {
+            "role": "user",
+            "content": _format_activity_weather_pair(activity, weather_condition),
+        },
+    ]
+
+    if cascade is not None:
+        verdict, resp = cascade.classify(messages, ["IS_COMPATIBLE", "IS_INCOMPATIBLE"])
+        if verdict is None:
+            raise RuntimeError(
+                f"Unexpected response from the model: {resp}. Expected 'IS_COMPATIBLE' or 'IS_INCOMPATIBLE'."
+            )
+        return verdict == "IS_COMPATIBLE"
+
+    resp = do_chat_completion(
+        messages=messages,
+        client=client,
+        # This is a high-frequency use case, so we use a fast and cheap model.
+        model=OpenAIModel.GPT_41_NANO,
+        cache=cache,
+    )
+
+    if "IS_COMPATIBLE" in (resp or ""):
+        return True
+    elif "IS_INCOMPATIBLE" in (resp or ""):
+        return False
+    else:
+        raise RuntimeError(
+            f"Unexpected response from the model: {resp}. Expected 'IS_COMPATIBLE' or 'IS_INCOMPATIBLE'."
+        )
+
+
+def _judge_activity_weather_pairs_batched(
+    pairs: list[tuple[Activity, str]],
+    content_prompt: str,
+    client: OpenAI | None,
+    batch_size: int,
+    cache=None,
+) -> list[bool | None]:
+    """Judges many (activity, weather condition) pairs with one structured-output request per chunk.
+
+    Returns:
+        list: One verdict per pair, in order. True for IS_COMPATIBLE, False for IS_INCOMPATIBLE and
+        None when the batch response could not be parsed or did not cover the pair.
+    """
+    from utils import do_chat_completion
+
+    verdicts: list[bool | None] = [None] * len(pairs)
+
+    for chunk_start in range(0, len(pairs), batch_size):
+        chunk = range(chunk_start, min(chunk_start + batch_size, len(pairs)))
+        user_prompt = "\n\n".join(
+            f"pair_id: {pair_id}\n{_format_activity_weather_pair(*pairs[pair_id])}"
+            for pair_id in chunk
+        )
+
+        try:
             resp = do_chat_completion(
                 messages=[
                     {
                         "role": "system",
-                        "content": content_prompt,
+                        "content": f"{content_prompt}\n\n{WEATHER_COMPATIBILITY_BATCH_INSTRUCTIONS}",
                     },
                     {
                         "role": "user",
-                        "content": f"Activity: {activity_recommendation.activity.name}\nDescription: {activity_recommendation.activity.description}\nWeather Condition: {weather_condition}",
+                        "content": user_prompt,
                     },
                 ],
                 client=client,
-                # This is a high-frequency use case, so we use a fast and cheap model.
                 model=OpenAIModel.GPT_41_NANO,
+                response_format=WeatherCompatibilityVerdicts,
+                cache=cache,
             )
-    
+            batch = WeatherCompatibilityVerdicts.model_validate_json(resp or "")
+        except (ValidationError, LengthFinishReasonError, ContentFilterFinishReasonError) as e:
+            # A truncated or filtered batch loses every verdict in it, not just one
+            print(f"Could not parse batched weather verdicts, falling back to per-pair calls: {e}")
+            continue
 
+        for verdict in batch.verdicts:
+            if verdict.pair_id in chunk:
+                verdicts[verdict.pair_id] = verdict.verdict == "IS_COMPATIBLE"
 
-            if "IS_COMPATIBLE" in (resp or ""):
-                is_compatible = True
-            elif "IS_INCOMPATIBLE" in (resp or ""):
-                is_compatible = False
-            else:
-                raise RuntimeError(
-                    f"Unexpected response from the model: {resp}. Expected 'IS_COMPATIBLE' or 'IS_INCOMPATIBLE'."
-                )
-
-            if is_compatible:
-                print(
-                    f"✅ Activity {activity_recommendation.activity.name} (on {itinerary_day.date}) and weather '{weather_condition}' are compatible."
-                )
-
-            else:
-                activities_that_are_incompatible.append(
-                    activity_recommendation.activity.name
-                )
-                print(
-                    f"❌ Activity {activity_recommendation.activity.name} (on {itinerary_day.date}) and weather '{weather_condition}' are incompatible."
-                )
-
-    if activities_that_are_incompatible:
-        raise AgentError(
-            f"Activities that may be ruined by inclement weather: {activities_that_are_incompatible}"
-        )
\ No newline at end of file
+    return verdicts
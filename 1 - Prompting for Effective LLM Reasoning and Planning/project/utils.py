@@ -1,9 +1,23 @@
 """Provides utility functions for the project."""
 
-from enum import Enum
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from enum import Enum, IntEnum
 
 SINGLE_TAB_LEVEL = 4
 
+# Upper bound on in-flight requests per model for the async completion engine
+MAX_CONCURRENT_REQUESTS_PER_MODEL = 16
+
 
 class Interest(str, Enum):
     ART = "art"
@@ -24,214 +38,3092 @@ class Interest(str, Enum):
     WRITING = "writing"
 
 
-class ChatAgent:
-    """A chat agent that interacts with OpenAI's API to facilitate conversations.
+# One bit per Interest, in declaration order
+INTEREST_BITS = {interest: 1 << bit for bit, interest in enumerate(Interest)}
+_INTERESTS_BY_BIT = {bit: interest for interest, bit in INTEREST_BITS.items()}
+
+
+def interests_to_mask(interests) -> int:
+    """Encodes interests as a bitmask, so that overlap checks are a single integer AND.
+
+    Args:
+        interests: Interest members or their string values.
+
+    Returns:
+        int: The bitmask with the bit of every interest set.
+
+    Examples:
+        >>> mask = interests_to_mask([Interest.ART, "music"])
+        >>> mask & interests_to_mask([Interest.MUSIC, Interest.HIKING]) != 0
+        True
+        >>> count_interests(mask)
+        2
+    """
+    mask = 0
+    for interest in interests:
+        mask |= INTEREST_BITS[Interest(interest)]
+    return mask
+
+
+def mask_to_interests(mask) -> list[Interest]:
+    """Decodes a bitmask from interests_to_mask into Interest members, in declaration order."""
+    interests = []
+    while mask:
+        lowest_bit = mask & -mask
+        interests.append(_INTERESTS_BY_BIT[lowest_bit])
+        mask ^= lowest_bit
+    return interests
+
+
+def count_interests(mask) -> int:
+    """Returns the number of interests in a bitmask."""
+    return mask.bit_count()
+
+
+class OpenAIModel(str, Enum):
+    GPT_41 = "gpt-4.1"
+    GPT_41_MINI = "gpt-4.1-mini"
+    GPT_41_NANO = "gpt-4.1-nano"
+
+
+# USD per million tokens, used to estimate the cost of completions
+MODEL_PRICES_PER_MILLION_TOKENS = {
+    OpenAIModel.GPT_41.value: {"input": 2.00, "cached_input": 0.50, "output": 8.00},
+    OpenAIModel.GPT_41_MINI.value: {"input": 0.40, "cached_input": 0.10, "output": 1.60},
+    OpenAIModel.GPT_41_NANO.value: {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+}
+
+
+class Priority(IntEnum):
+    """Admission priority of a completion request. Lower values are admitted first."""
+
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+
+
+class ChatAgent:
+    """A chat agent that interacts with OpenAI's API to facilitate conversations.
+
+    This class manages chat history, formats system prompts, and handles
+    communication with OpenAI's chat completion API. It provides methods to
+    add messages, get responses, and maintain conversation context.
+
+    The system prompt can be split in two for provider-side prompt caching: the
+    `system_prompt` holds the part that is identical for every conversation, and the
+    optional `prompt_context` holds per-conversation data (weather, activities,
+    traveler details, ...). The context is sent as a second system message right after
+    the static prompt, so consecutive conversations share the longest possible prefix.
+    Use `split_prompt_template` or `ChatAgent.from_prompt_template` to build both parts
+    from a single template.
+
+    Attributes:
+        system_prompt_template (str): Template for the system prompt using {variable_name} placeholders.
+        usage (dict): Running totals of requests, prompt, cached and completion tokens
+            reported by the API for this agent's completions.
+        priority (Priority): The scheduler priority of this agent's completions. Agents
+            talk to a user, so they are INTERACTIVE unless a subclass says otherwise.
+    """
+    system_prompt = "You are a helpful assistant."
+    prompt_context = None
+    priority = Priority.INTERACTIVE
+
+    def __init__(
+        self,
+        name=None,
+        system_prompt=None,
+        client=None,
+        model=None,
+        cache=None,
+        history_manager=None,
+        prompt_context=None,
+    ):
+        self.name = name or self.__class__.__name__
+        # Initialize messages as instance attribute to avoid shared state bug
+        self.messages = []
+        # Use provided system_prompt, or fall back to class attribute (which subclasses can override)
+        self.system_prompt = system_prompt if system_prompt else getattr(self.__class__, 'system_prompt', "You are a helpful assistant.")
+        self.client = client
+        self.model = model
+        # Optional ResponseCache shared by every completion this agent makes
+        self.cache = cache
+        # Optional ChatHistoryManager keeping the history within a token budget
+        self.history_manager = history_manager
+        # Volatile, per-conversation part of the system prompt (see the class docstring)
+        self.prompt_context = prompt_context if prompt_context else getattr(self.__class__, 'prompt_context', None)
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.reset()
+
+    @classmethod
+    def from_prompt_template(cls, template, static_values=None, volatile_values=None, **kwargs):
+        """Creates an agent whose system prompt is laid out for prompt caching.
+
+        Args:
+            template (str): A str.format template for the system prompt.
+            static_values (dict, optional): Values that are the same for every conversation.
+            volatile_values (dict, optional): Per-conversation values. They are moved out of
+                the system prompt into the prompt context message.
+            **kwargs: Passed on to the agent's constructor.
+
+        Returns:
+            ChatAgent: The new agent.
+        """
+        system_prompt, prompt_context = split_prompt_template(
+            template, static_values=static_values, volatile_values=volatile_values
+        )
+        return cls(system_prompt=system_prompt, prompt_context=prompt_context, **kwargs)
+
+    @property
+    def cached_token_ratio(self) -> float:
+        """The share of this agent's prompt tokens that the API served from its prompt cache."""
+        if not self.usage["prompt_tokens"]:
+            return 0.0
+        return self.usage["cached_tokens"] / self.usage["prompt_tokens"]
+
+    def _record_usage(self, usage):
+        """Adds the token counts of one API response to `usage`."""
+        prompt_tokens, cached_tokens, completion_tokens = _get_usage_tokens(usage)
+        self.usage["requests"] += 1
+        self.usage["prompt_tokens"] += prompt_tokens
+        self.usage["cached_tokens"] += cached_tokens
+        self.usage["completion_tokens"] += completion_tokens
+
+    def add_message(self, role, content, tool_calls=None, tool_call_id=None):
+        """Add a message to the chat history.
+
+        Args:
+            role (str): The role of the message ("system", "user", "assistant" or "tool").
+            content (str): The content of the message.
+            tool_calls (list[dict], optional): The tool calls of an assistant message, as
+                returned by `get_tool_response`.
+            tool_call_id (str, optional): The id of the tool call a "tool" message answers.
+
+        Raises:
+            ValueError: If the role is not one of "system", "user", "assistant" or "tool",
+                or a "tool" message has no tool_call_id.
+        """
+        if role not in ["system", "user", "assistant", "tool"]:
+            raise ValueError(f"Invalid role: {role}")
+        if role == "tool" and not tool_call_id:
+            raise ValueError("A tool message needs the tool_call_id it answers")
+        message = {"role": role, "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        if tool_call_id:
+            message["tool_call_id"] = tool_call_id
+        self.messages.append(message)
+        if role == "system":
+            print_in_box(
+                content,
+                f"{self.name} - System Prompt",
+            )
+        elif role == "user":
+            print_in_box(
+                content,
+                f"{self.name} - User Prompt",
+            )
+        elif role == "assistant":
+            print_in_box(
+                "\n".join(
+                    [content or ""]
+                    + [
+                        f"TOOL CALL: {tool_call['function']['name']}({tool_call['function']['arguments']})"
+                        for tool_call in tool_calls or []
+                    ]
+                ).strip(),
+                f"{self.name} - Assistant Response",
+            )
+        elif role == "tool":
+            print_in_box(
+                content,
+                f"{self.name} - Tool Result",
+            )
+
+    def reset(self):
+        """Reset the chat history and re-initialize with the system prompt.
+
+        This method clears all existing messages and adds the system prompt
+        formatted with the template_kwargs.
+        """
+        from textwrap import dedent
+
+        system_prompt = dedent(self.system_prompt).strip()
+
+        # Clear previous messages and add the system prompt
+        self.messages = []
+        self.add_message(
+            "system",
+            system_prompt,
+        )
+        # The volatile context goes after the static prompt to keep the shared prefix long
+        if self.prompt_context:
+            self.add_message(
+                "system",
+                dedent(self.prompt_context).strip(),
+            )
+
+    def get_response(self, add_to_messages=True, model=None, client=None, **kwargs):
+        """Get a response from the OpenAI API.
+
+        Args:
+            add_to_messages (bool, optional): Whether to add the response to the chat history
+            using the add_message method and the assistant role. Defaults to True.
+
+        Returns:
+            str: The response from the OpenAI API.
+
+
+        """
+        response = do_chat_completion(
+            **self._get_completion_kwargs(model=model, client=client, **kwargs)
+        )
+        if add_to_messages:
+            self.add_message("assistant", response)
+        return response
+
+    def get_tool_response(
+        self, tools, add_to_messages=True, model=None, client=None, parallel_tool_calls=True, **kwargs
+    ):
+        """Get a response that may call tools natively instead of describing the calls in text.
+
+        Args:
+            tools (list): The tools the model may call: functions (see `get_tool_schemas`)
+                or ready-made tool schemas.
+            add_to_messages (bool, optional): Whether to add the response, tool calls included,
+                to the chat history. Defaults to True.
+            parallel_tool_calls (bool, optional): Whether the model may call several tools
+                in one response. Defaults to True.
+            **kwargs: Passed on to `do_chat_completion`, e.g. tool_choice="required".
+
+        Returns:
+            dict: The assistant message, with a `tool_calls` list when the model called tools.
+            Every call must be answered with a "tool" message (see `add_message`) before the
+            next response.
+        """
+        message = do_chat_completion(
+            **self._get_completion_kwargs(
+                model=model,
+                client=client,
+                tools=get_tool_schemas(tools),
+                parallel_tool_calls=parallel_tool_calls,
+                return_message=True,
+                **kwargs,
+            )
+        )
+        if add_to_messages:
+            self.add_message("assistant", message["content"], tool_calls=message.get("tool_calls"))
+        return message
+
+    def chat(self, user_message, add_to_messages=True, model=None, **kwargs):
+        """Send a message to the chat and get a response.
+
+        Pass `stream=True` to receive the response incrementally: every text delta is
+        handed to the optional `on_delta` callback as it arrives, and the assembled
+        response is still added to the chat history and returned.
+
+        Args:
+            user_message (str): The message to send to the chat.
+
+        Returns:
+            str: The response from the OpenAI API.
+        """
+        self.add_message("user", user_message)
+        return self.get_response(add_to_messages=add_to_messages, model=model, **kwargs)
+
+    def stream_response(self, add_to_messages=True, model=None, client=None, **kwargs):
+        """Stream a response from the OpenAI API, yielding text deltas as they arrive.
+
+        Once the stream is exhausted, the assembled response is added to the chat
+        history like `get_response` does.
+
+        Args:
+            add_to_messages (bool, optional): Whether to add the response to the chat history
+            using the add_message method and the assistant role. Defaults to True.
+
+        Yields:
+            str: The next chunk of the response text.
+        """
+        deltas = []
+        for delta in stream_chat_completion(
+            **self._get_completion_kwargs(model=model, client=client, **kwargs)
+        ):
+            deltas.append(delta)
+            yield delta
+        if add_to_messages:
+            self.add_message("assistant", "".join(deltas))
+
+    def stream_chat(self, user_message, add_to_messages=True, model=None, **kwargs):
+        """Send a message to the chat and stream the response as text deltas.
+
+        Args:
+            user_message (str): The message to send to the chat.
+
+        Yields:
+            str: The next chunk of the response text.
+        """
+        self.add_message("user", user_message)
+        yield from self.stream_response(add_to_messages=add_to_messages, model=model, **kwargs)
+
+    def _get_completion_kwargs(self, model=None, client=None, **kwargs):
+        """Build the keyword arguments for a completion call on the current chat history.
+
+        Shared by the sync and async agents so both send exactly the same request.
+        The history is compacted first when the agent has a history manager.
+        """
+        if self.history_manager is not None:
+            self.messages = self.history_manager.compact(self.messages)
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("on_usage", self._record_usage)
+        kwargs.setdefault("agent_name", self.name)
+        kwargs.setdefault("priority", self.priority)
+        return dict(
+            messages=self.messages,
+            model=model or self.model,
+            client=client or self.client,
+            **kwargs
+        )
+
+
+class AsyncChatAgent(ChatAgent):
+    """A ChatAgent whose completions are awaited instead of blocking a thread.
+
+    The chat history handling is inherited from ChatAgent; only `get_response` and
+    `chat` become coroutines backed by `ado_chat_completion`. Many agents can then be
+    driven from a single event loop, e.g. with `asyncio.gather`, while the per-model
+    semaphore keeps the number of in-flight requests bounded.
+
+    The client should be an `openai.AsyncOpenAI` instance. A sync `openai.OpenAI`
+    client still works, but each call is then pushed to a worker thread.
+    """
+
+    async def get_response(self, add_to_messages=True, model=None, client=None, **kwargs):
+        """Get a response from the OpenAI API without blocking the event loop.
+
+        Args:
+            add_to_messages (bool, optional): Whether to add the response to the chat history
+            using the add_message method and the assistant role. Defaults to True.
+
+        Returns:
+            str: The response from the OpenAI API.
+        """
+        response = await ado_chat_completion(
+            **self._get_completion_kwargs(model=model, client=client, **kwargs)
+        )
+        if add_to_messages:
+            self.add_message("assistant", response)
+        return response
+
+    async def chat(self, user_message, add_to_messages=True, model=None, **kwargs):
+        """Send a message to the chat and await a response.
+
+        Args:
+            user_message (str): The message to send to the chat.
+
+        Returns:
+            str: The response from the OpenAI API.
+        """
+        self.add_message("user", user_message)
+        return await self.get_response(add_to_messages=add_to_messages, model=model, **kwargs)
+
+
+def print_in_box(text, title="", cols=120, tab_level=0):
+    """
+    Prints the given text in a box with the specified title and dimensions.
+
+    Args:
+        text: The text to print in the box.
+        title: The title of the box.
+        cols: The width of the box.
+        tab_level: The level of indentation for the box.
+    """
+    import textwrap
+
+    text = str(text)
+
+    # Make a box using extended ASCII characters
+    if cols < 4 + tab_level * SINGLE_TAB_LEVEL:
+        cols = 4 + tab_level * SINGLE_TAB_LEVEL
+
+    tabs = " " * tab_level * SINGLE_TAB_LEVEL
+
+    top = (
+        tabs
+        + "\u2554"
+        + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
+        + "\u2557"
+    )
+    if tab_level == 0:
+        print()  # Print a newline before any box at level 0
+
+    if title:
+        # replace the middle of the top with the title
+        title = "[ " + title + " ]"
+        top = top[: (cols - len(title)) // 2] + title + top[(cols + len(title)) // 2 :]
+    print(top)
+
+    for line in text.split("\n"):
+        for wrapped_line in textwrap.wrap(
+            line, cols - 4 - tab_level * SINGLE_TAB_LEVEL
+        ):
+            print(
+                f"{tabs}\u2551 {wrapped_line:<{cols - 4 - tab_level * SINGLE_TAB_LEVEL}} \u2551"
+            )
+
+    print(
+        f"{tabs}\u255a"
+        + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
+        + "\u255d"
+    )
+
+
+def do_chat_completion(
+    messages: list[dict[str, str]],
+    model=None,
+    client=None,
+    cache=None,
+    stream=False,
+    on_delta=None,
+    on_usage=None,
+    agent_name=None,
+    scheduler=None,
+    priority=None,
+    return_message=False,
+    **kwargs,
+):
+    """A simple wrapper around OpenAI's chat completion API.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        client: An `openai.OpenAI` client. Defaults to the shared client of get_openai_client.
+            Its own retries are turned off, since the scheduler retries.
+        cache: An optional ResponseCache. Identical requests (same messages, model and
+            keyword arguments) are then answered from the cache instead of the API.
+        stream: Whether to stream the response. The text deltas are passed to `on_delta`
+            as they arrive and the assembled text is returned, so callers see the first
+            tokens early without changing how they consume the result.
+        on_delta: An optional callback receiving each text delta when streaming.
+        on_usage: An optional callback receiving the `usage` object of the API response
+            (prompt, cached and completion tokens). Not called for cached responses.
+        agent_name: The name of the calling agent, passed on to the instrumentation hooks.
+        scheduler: The CompletionScheduler that admits, rate limits and retries the
+            request. Defaults to the process-wide one (see get_completion_scheduler).
+        priority: The scheduler Priority of the request. Defaults to BULK inside an
+            evaluation and NORMAL otherwise.
+        return_message: Whether to return the whole assistant message as a chat history
+            dict, including any `tool_calls` (see `get_tool_schemas`), instead of its text.
+            Not supported when streaming.
+
+    Returns:
+        str: The response from the chat completion API, or the assistant message dict when
+        return_message is set.
+
+    Raises:
+        openai.OpenAIError: If the chat completion API returns an error.
+        CircuitOpenError: If the scheduler is failing fast for this model.
+        ValueError: If both stream and return_message are set.
+
+    Examples:
+        >>> messages = [
+        ...     {"role": "user", "content": "Hello, how are you?"},
+        ...     {"role": "assistant", "content": "I'm good, thanks!"},
+        ... ]
+        >>> from unittest.mock import patch
+        >>> with patch('openai.OpenAI') as mock_openai:
+        ...     # Setup mock response
+        ...     mock_client = mock_openai.return_value
+        ...     mock_chat = mock_client.chat
+        ...     mock_completions = mock_chat.completions
+        ...     mock_create = mock_completions.create
+        ...     mock_response = mock_create.return_value
+        ...     mock_response.choices = [type('obj', (object,), {'message': type('msg', (object,), {'content': "I'm good, thanks!"})()})]
+        ...     response = do_chat_completion(messages)
+        >>> response
+        "I'm good, thanks!"
+    """
+    if stream and return_message:
+        raise ValueError("return_message is not supported when streaming")
+    if stream:
+        deltas = []
+        for delta in stream_chat_completion(
+            messages,
+            model=model,
+            client=client,
+            cache=cache,
+            on_usage=on_usage,
+            agent_name=agent_name,
+            scheduler=scheduler,
+            priority=priority,
+            **kwargs,
+        ):
+            if on_delta is not None:
+                on_delta(delta)
+            deltas.append(delta)
+        return "".join(deltas)
+
+    with _track_completion(model, agent_name) as record:
+        if cache is not None:
+            cache_key = _get_completion_cache_key(cache, messages, model, kwargs, return_message)
+            cached_content = cache.get(cache_key)
+            if cached_content is not None:
+                record.cache_hit = True
+                return _load_cached_completion(cached_content, return_message)
+
+        client = client or get_openai_client()
+        _check_completion_args(model, client)
+        client = _without_client_retries(client)
+
+        create = _get_completion_method(client, kwargs)
+        call = _get_scheduled_call(scheduler, priority, model, messages, kwargs, record)
+        response = call(
+            lambda: create(
+                model=model,
+                messages=messages,  # type: ignore
+                **kwargs,  # type: ignore
+            )
+        )
+
+        content = _get_completion_content(response)
+        _report_usage(_chain_usage_callbacks(record, on_usage), response)
+        if return_message:
+            message = _get_completion_message(response)
+            if cache is not None:
+                cache.set(cache_key, _dump_cached_completion(message))
+            return message
+        if cache is not None and content is not None:
+            cache.set(cache_key, content)
+        return content
+
+
+def stream_chat_completion(
+    messages: list[dict[str, str]],
+    model=None,
+    client=None,
+    cache=None,
+    on_usage=None,
+    agent_name=None,
+    scheduler=None,
+    priority=None,
+    **kwargs,
+):
+    """Streams a chat completion, yielding the text deltas as they arrive.
+
+    Structured outputs (a `response_format` keyword argument) are streamed through the
+    beta parse-streaming helper, so the deltas are fragments of the JSON document.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        client: An `openai.OpenAI` client. Defaults to the shared client of get_openai_client.
+        cache: An optional ResponseCache. A cached response is yielded as a single delta,
+            and a fully streamed response is stored once the stream completes.
+        on_usage: An optional callback receiving the `usage` object once the stream completes.
+        agent_name: The name of the calling agent, passed on to the instrumentation hooks.
+        scheduler: The CompletionScheduler, as in `do_chat_completion`. It admits and
+            retries opening the stream; a stream that fails midway is not retried.
+        priority: The scheduler Priority of the request.
+
+    Yields:
+        str: The next chunk of the response text.
+
+    Raises:
+        openai.OpenAIError: If the chat completion API returns an error.
+    """
+    with _track_completion(model, agent_name, streamed=True) as record:
+        if cache is not None:
+            cache_key = cache.make_key(messages, model, **kwargs)
+            cached_content = cache.get(cache_key)
+            if cached_content is not None:
+                record.cache_hit = True
+                yield cached_content
+                return
+
+        client = client or get_openai_client()
+        _check_completion_args(model, client)
+        client = _without_client_retries(client)
+
+        deltas = []
+        call = _get_scheduled_call(scheduler, priority, model, messages, kwargs, record)
+        # Closing the delta generator when the consumer stops early closes the HTTP response
+        with contextlib.closing(
+            _stream_completion_deltas(
+                messages, model, client, kwargs, _chain_usage_callbacks(record, on_usage), call
+            )
+        ) as completion_deltas:
+            for delta in completion_deltas:
+                record.record_first_token()
+                deltas.append(delta)
+                yield delta
+
+        # Only a stream that ran to completion is worth caching
+        if cache is not None and deltas:
+            cache.set(cache_key, "".join(deltas))
+
+
+def _stream_completion_deltas(messages, model, client, kwargs, on_usage=None, call=None):
+    """Yields the text deltas of a completion streamed from a sync client.
+
+    `call` runs the function opening the stream, e.g. through a scheduler.
+    """
+    call = call or (lambda fn: fn())
+    if "response_format" not in kwargs:
+        if on_usage is not None:
+            # Usage is only sent on streams that ask for it, in a final chunk without choices
+            kwargs = {"stream_options": {"include_usage": True}, **kwargs}
+        completion_stream = call(
+            lambda: client.chat.completions.create(  # type: ignore
+                model=model,
+                messages=messages,  # type: ignore
+                stream=True,
+                **kwargs,  # type: ignore
+            )
+        )
+        try:
+            for chunk in completion_stream:
+                _report_usage(on_usage, chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closing the HTTP response when the consumer stops early (e.g. a malformed
+            # plan was detected) stops paying for the remaining tokens
+            if hasattr(completion_stream, "close"):
+                completion_stream.close()
+    else:
+        with contextlib.ExitStack() as stack:
+            completion_stream = call(
+                lambda: stack.enter_context(
+                    client.beta.chat.completions.stream(  # type: ignore
+                        model=model,
+                        messages=messages,  # type: ignore
+                        **kwargs,  # type: ignore
+                    )
+                )
+            )
+            for event in completion_stream:
+                if event.type == "content.delta" and event.delta:
+                    yield event.delta
+            if on_usage is not None:
+                _report_usage(on_usage, completion_stream.get_final_completion())
+
+
+def _collect_stream_deltas(messages, model, client, kwargs, on_usage, on_delta, record, call):
+    """Consumes a sync stream, for running streamed requests of a sync client in a thread."""
+    deltas = []
+    with contextlib.closing(
+        _stream_completion_deltas(messages, model, client, kwargs, on_usage, call)
+    ) as completion_deltas:
+        for delta in completion_deltas:
+            record.record_first_token()
+            if on_delta is not None:
+                on_delta(delta)
+            deltas.append(delta)
+    return deltas
+
+
+async def ado_chat_completion(
+    messages: list[dict[str, str]],
+    model=None,
+    client=None,
+    max_concurrency=None,
+    cache=None,
+    stream=False,
+    on_delta=None,
+    on_usage=None,
+    agent_name=None,
+    scheduler=None,
+    priority=None,
+    return_message=False,
+    **kwargs,
+):
+    """The async counterpart of `do_chat_completion`.
+
+    Requests are admitted through a per-model semaphore so that a single event loop can
+    drive many conversations at once without exceeding `max_concurrency` in-flight
+    requests for any one model.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        model: The model to use.
+        client: An `openai.AsyncOpenAI` client. A sync client is accepted too, in which
+            case the call runs in a worker thread. Defaults to the shared async client of
+            get_openai_client.
+        max_concurrency: The in-flight request limit for this model. Defaults to
+            MAX_CONCURRENT_REQUESTS_PER_MODEL. Only applied when the model's semaphore is
+            first created on the running event loop.
+        cache: An optional ResponseCache, as in `do_chat_completion`.
+        stream: Whether to stream the response, as in `do_chat_completion`.
+        on_delta: An optional callback receiving each text delta when streaming.
+        on_usage: An optional callback receiving the `usage` object of the API response.
+        agent_name: The name of the calling agent, passed on to the instrumentation hooks.
+        scheduler: The CompletionScheduler, as in `do_chat_completion`.
+        priority: The scheduler Priority of the request.
+        return_message: Whether to return the whole assistant message dict, as in
+            `do_chat_completion`.
+
+    Returns:
+        str: The response from the chat completion API, or the assistant message dict when
+        return_message is set.
+
+    Raises:
+        openai.OpenAIError: If the chat completion API returns an error.
+        CircuitOpenError: If the scheduler is failing fast for this model.
+        ValueError: If both stream and return_message are set.
+
+    Examples:
+        >>> import asyncio
+        >>> from unittest.mock import AsyncMock
+        >>> mock_client = AsyncMock()
+        >>> mock_response = mock_client.chat.completions.create.return_value
+        >>> mock_response.choices = [type('obj', (object,), {'message': type('msg', (object,), {'content': "Hi!"})()})]
+        >>> del mock_response.error
+        >>> asyncio.run(ado_chat_completion([{"role": "user", "content": "Hello"}], model="gpt-4.1-nano", client=mock_client))
+        'Hi!'
+    """
+    if stream and return_message:
+        raise ValueError("return_message is not supported when streaming")
+    with _track_completion(model, agent_name, streamed=stream) as record:
+        if cache is not None:
+            cache_key = _get_completion_cache_key(cache, messages, model, kwargs, return_message)
+            cached_content = cache.get(cache_key)
+            if cached_content is not None:
+                record.cache_hit = True
+                return _load_cached_completion(cached_content, return_message)
+
+        client = client or get_openai_client(async_client=True)
+        _check_completion_args(model, client)
+        client = _without_client_retries(client)
+        on_usage = _chain_usage_callbacks(record, on_usage)
+        is_async = _is_async_client(client)
+        call = _get_scheduled_call(
+            scheduler, priority, model, messages, kwargs, record, is_async=is_async
+        )
+
+        if stream:
+            async with get_model_semaphore(model, max_concurrency):
+                if not is_async:
+                    deltas = await asyncio.to_thread(
+                        _collect_stream_deltas,
+                        messages,
+                        model,
+                        client,
+                        kwargs,
+                        on_usage,
+                        on_delta,
+                        record,
+                        call,
+                    )
+                else:
+                    deltas = []
+                    async for delta in _astream_completion_deltas(
+                        messages, model, client, kwargs, on_usage, call
+                    ):
+                        record.record_first_token()
+                        if on_delta is not None:
+                            on_delta(delta)
+                        deltas.append(delta)
+            content = "".join(deltas)
+            if cache is not None and deltas:
+                cache.set(cache_key, content)
+            return content
+
+        create = _get_completion_method(client, kwargs)
+        async with get_model_semaphore(model, max_concurrency):
+            request = lambda: create(
+                model=model,
+                messages=messages,  # type: ignore
+                **kwargs,  # type: ignore
+            )
+            if is_async:
+                response = await call(request)
+            else:
+                response = await asyncio.to_thread(call, request)
+
+        content = _get_completion_content(response)
+        _report_usage(on_usage, response)
+        if return_message:
+            message = _get_completion_message(response)
+            if cache is not None:
+                cache.set(cache_key, _dump_cached_completion(message))
+            return message
+        if cache is not None and content is not None:
+            cache.set(cache_key, content)
+        return content
+
+
+async def _astream_completion_deltas(messages, model, client, kwargs, on_usage=None, call=None):
+    """Yields the text deltas of a completion streamed from an async client.
+
+    `call` awaits the coroutine function opening the stream, e.g. through a scheduler.
+    """
+    call = call or _await_call
+    if "response_format" not in kwargs:
+        if on_usage is not None:
+            kwargs = {"stream_options": {"include_usage": True}, **kwargs}
+        completion_stream = await call(
+            lambda: client.chat.completions.create(  # type: ignore
+                model=model,
+                messages=messages,  # type: ignore
+                stream=True,
+                **kwargs,  # type: ignore
+            )
+        )
+        async for chunk in completion_stream:
+            _report_usage(on_usage, chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    else:
+        async with contextlib.AsyncExitStack() as stack:
+            completion_stream = await call(
+                lambda: stack.enter_async_context(
+                    client.beta.chat.completions.stream(  # type: ignore
+                        model=model,
+                        messages=messages,  # type: ignore
+                        **kwargs,  # type: ignore
+                    )
+                )
+            )
+            async for event in completion_stream:
+                if event.type == "content.delta" and event.delta:
+                    yield event.delta
+            if on_usage is not None:
+                _report_usage(on_usage, await completion_stream.get_final_completion())
+
+
+async def _await_call(fn):
+    return await fn()
+
+
+def _get_scheduled_call(scheduler, priority, model, messages, kwargs, record, is_async=False):
+    """Returns a function running a request callable through the scheduler.
+
+    The retries the scheduler makes are recorded on the CompletionRecord.
+    """
+    scheduler = scheduler or get_completion_scheduler()
+    return functools.partial(
+        scheduler.acall if is_async else scheduler.call,
+        model=model,
+        priority=_get_request_priority(priority),
+        estimated_tokens=_estimate_request_tokens(messages, kwargs),
+        on_retry=record.record_retry,
+    )
+
+
+# Semaphores are bound to the event loop they are first used on, so keep one set per loop
+_MODEL_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def get_model_semaphore(model, max_concurrency=None) -> asyncio.Semaphore:
+    """Returns the semaphore bounding in-flight requests for a model on the running event loop.
+
+    Args:
+        model: The model the semaphore guards.
+        max_concurrency: The limit used when the semaphore is created. Defaults to
+            MAX_CONCURRENT_REQUESTS_PER_MODEL.
+
+    Returns:
+        asyncio.Semaphore: The semaphore shared by all requests to `model` on this loop.
+    """
+    loop = asyncio.get_running_loop()
+    semaphores = _MODEL_SEMAPHORES.setdefault(loop, {})
+    # Enum members and their string values share one semaphore
+    key = getattr(model, "value", model)
+    if key not in semaphores:
+        semaphores[key] = asyncio.Semaphore(
+            max_concurrency or MAX_CONCURRENT_REQUESTS_PER_MODEL
+        )
+    return semaphores[key]
+
+
+def _check_completion_args(model, client):
+    if client is None:
+        raise ValueError("A valid OpenAI client must be provided.")
+
+    if model is None:
+        raise ValueError("A valid model must be provided.")
+
+
+_CLIENTS_WITHOUT_RETRIES = weakref.WeakKeyDictionary()
+
+
+def _without_client_retries(client):
+    """Returns a copy of an openai client that leaves retrying to the CompletionScheduler.
+
+    The SDK retries twice by default, and its retries would multiply with the scheduler's.
+    Clients that are not openai clients (e.g. test doubles) are returned unchanged.
+    """
+    from openai import AsyncOpenAI, OpenAI
+
+    if not isinstance(client, (OpenAI, AsyncOpenAI)) or client.max_retries == 0:
+        return client
+    client_without_retries = _CLIENTS_WITHOUT_RETRIES.get(client)
+    if client_without_retries is None:
+        # with_options shares the connection pool, and the copy is made once per client
+        client_without_retries = _CLIENTS_WITHOUT_RETRIES[client] = client.with_options(max_retries=0)
+    return client_without_retries
+
+
+def _get_completion_method(client, kwargs):
+    """Structured outputs go through the parse helper, everything else through create."""
+    if "response_format" not in kwargs:
+        return client.chat.completions.create  # type: ignore
+    return client.beta.chat.completions.parse  # type: ignore
+
+
+def _is_async_client(client):
+    from openai import AsyncOpenAI
+
+    return isinstance(client, AsyncOpenAI) or asyncio.iscoroutinefunction(
+        client.chat.completions.create
+    )
+
+
+def _report_usage(on_usage, response):
+    """Passes the usage of a response or stream chunk to on_usage, when both are present."""
+    usage = getattr(response, "usage", None)
+    if on_usage is not None and usage is not None:
+        on_usage(usage)
+
+
+class CompletionRecord:
+    """The measurements taken for one chat completion call.
+
+    Attributes:
+        model (str): The model the request was sent to.
+        agent_name (str | None): The name of the ChatAgent that made the call, if any.
+        eval_name (str | None): The evaluation function running when the call was made.
+        streamed (bool): Whether the response was streamed.
+        prompt_tokens (int): Prompt tokens billed for the call.
+        cached_tokens (int): The part of the prompt tokens served from the provider's prompt cache.
+        completion_tokens (int): Completion tokens billed for the call.
+        latency_s (float | None): Wall time of the call, including local queueing.
+        time_to_first_token_s (float | None): Seconds until the first streamed delta.
+            Only measured for streamed calls.
+        retries (int): How many times the request was retried before it succeeded or gave up.
+        cache_hit (bool): Whether the response came from a ResponseCache.
+        error (str | None): The exception type name if the call failed.
+    """
+
+    def __init__(self, model, agent_name=None, eval_name=None, streamed=False):
+        self.model = getattr(model, "value", model)
+        self.agent_name = agent_name
+        self.eval_name = eval_name
+        self.streamed = streamed
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latency_s = None
+        self.time_to_first_token_s = None
+        self.retries = 0
+        self.cache_hit = False
+        self.error = None
+        self._started_at = time.perf_counter()
+
+    def record_usage(self, usage):
+        """Adds the token counts of an API `usage` object."""
+        prompt_tokens, cached_tokens, completion_tokens = _get_usage_tokens(usage)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.completion_tokens += completion_tokens
+
+    def record_retry(self, retries):
+        """Sets the number of retries made so far."""
+        self.retries = retries
+
+    def record_first_token(self):
+        """Marks the arrival of the first streamed delta."""
+        if self.time_to_first_token_s is None:
+            self.time_to_first_token_s = time.perf_counter() - self._started_at
+
+    def to_dict(self) -> dict:
+        return {
+            key: value for key, value in vars(self).items() if not key.startswith("_")
+        }
+
+
+def _get_usage_tokens(usage):
+    """Returns the prompt, cached and completion tokens of an API `usage` object."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (
+        getattr(usage, "prompt_tokens", 0) or 0,
+        getattr(details, "cached_tokens", 0) or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+    )
+
+
+_INSTRUMENTATION_HOOKS = []
+
+_CURRENT_EVAL_NAME = contextvars.ContextVar("current_eval_name", default=None)
+
+
+def register_instrumentation_hook(hook):
+    """Registers a callable that receives a CompletionRecord after every completion call.
+
+    Hooks run on the thread (or event loop) that made the call, so they should be cheap.
+    Exceptions raised by a hook are not caught.
+
+    Args:
+        hook: A callable taking a CompletionRecord, e.g. a CompletionMetrics instance.
+
+    Returns:
+        The hook, so this can be used as a decorator.
+    """
+    if hook not in _INSTRUMENTATION_HOOKS:
+        _INSTRUMENTATION_HOOKS.append(hook)
+    return hook
+
+
+def unregister_instrumentation_hook(hook):
+    """Removes a hook added with register_instrumentation_hook, if it is registered."""
+    if hook in _INSTRUMENTATION_HOOKS:
+        _INSTRUMENTATION_HOOKS.remove(hook)
+
+
+@contextlib.contextmanager
+def eval_context(eval_name):
+    """Attributes the completion calls made inside the block to an evaluation function.
+
+    Args:
+        eval_name (str): The name of the evaluation function.
+    """
+    token = _CURRENT_EVAL_NAME.set(eval_name)
+    try:
+        yield
+    finally:
+        _CURRENT_EVAL_NAME.reset(token)
+
+
+@contextlib.contextmanager
+def _track_completion(model, agent_name=None, streamed=False):
+    """Measures a completion call and hands the record to the instrumentation hooks."""
+    record = CompletionRecord(
+        model, agent_name=agent_name, eval_name=_CURRENT_EVAL_NAME.get(), streamed=streamed
+    )
+    try:
+        yield record
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.latency_s = time.perf_counter() - record._started_at
+        for hook in list(_INSTRUMENTATION_HOOKS):
+            hook(record)
+
+
+def _chain_usage_callbacks(record, on_usage):
+    """Returns an on_usage callback that feeds both the record and the caller's callback."""
+
+    def on_usage_with_record(usage):
+        record.record_usage(usage)
+        if on_usage is not None:
+            on_usage(usage)
+
+    return on_usage_with_record
+
+
+class _Histogram:
+    """A cumulative histogram with fixed upper bounds, in the Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Yields (upper bound, observations <= bound) pairs, ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            "buckets": {
+                ("+Inf" if bound == float("inf") else str(bound)): count
+                for bound, count in self.cumulative_counts()
+            },
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class CompletionMetrics:
+    """Aggregates CompletionRecords into per-agent and per-eval histograms.
+
+    An instance is an instrumentation hook. Calls without an agent name are grouped under
+    "unknown"; calls made outside an evaluation are only counted per agent.
+
+    Examples:
+        >>> metrics = register_instrumentation_hook(CompletionMetrics())
+        >>> record = CompletionRecord("gpt-4.1-nano", agent_name="ItineraryAgent")
+        >>> record.prompt_tokens, record.completion_tokens, record.latency_s = 1200, 300, 0.8
+        >>> metrics(record)
+        >>> metrics.to_dict()["agent"]["ItineraryAgent"]["requests"]
+        1
+        >>> print(metrics.to_prometheus().splitlines()[2])
+        llm_completion_requests_total{agent="ItineraryAgent"} 1
+        >>> unregister_instrumentation_hook(metrics)
+    """
+
+    LATENCY_BUCKETS_S = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+    HISTOGRAMS = {
+        "latency_seconds": ("latency_s", LATENCY_BUCKETS_S),
+        "time_to_first_token_seconds": ("time_to_first_token_s", LATENCY_BUCKETS_S),
+        "prompt_tokens": ("prompt_tokens", TOKEN_BUCKETS),
+        "cached_tokens": ("cached_tokens", TOKEN_BUCKETS),
+        "completion_tokens": ("completion_tokens", TOKEN_BUCKETS),
+    }
+    COUNTERS = ("requests", "retries", "errors", "cache_hits")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {"agent" | "eval": {name: {"counters": {...}, "histograms": {...}}}}
+        self._series = {"agent": {}, "eval": {}}
+
+    def __call__(self, record: CompletionRecord):
+        with self._lock:
+            self._observe("agent", record.agent_name or "unknown", record)
+            if record.eval_name is not None:
+                self._observe("eval", record.eval_name, record)
+
+    def _observe(self, dimension, name, record):
+        series = self._series[dimension].get(name)
+        if series is None:
+            series = self._series[dimension][name] = {
+                "counters": dict.fromkeys(self.COUNTERS, 0),
+                "histograms": {
+                    metric: _Histogram(buckets)
+                    for metric, (_, buckets) in self.HISTOGRAMS.items()
+                },
+            }
+        counters = series["counters"]
+        counters["requests"] += 1
+        counters["retries"] += record.retries
+        counters["errors"] += record.error is not None
+        counters["cache_hits"] += record.cache_hit
+        if record.cache_hit:
+            # Cached responses cost nothing and would skew the latency distribution
+            return
+        for metric, (attribute, _) in self.HISTOGRAMS.items():
+            value = getattr(record, attribute)
+            if value is not None:
+                series["histograms"][metric].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._series = {"agent": {}, "eval": {}}
+
+    def to_dict(self) -> dict:
+        """Returns the counters and histograms, keyed by dimension then agent or eval name."""
+        with self._lock:
+            return {
+                dimension: {
+                    name: {
+                        **series["counters"],
+                        **{
+                            metric: histogram.to_dict()
+                            for metric, histogram in series["histograms"].items()
+                        },
+                    }
+                    for name, series in by_name.items()
+                }
+                for dimension, by_name in self._series.items()
+            }
+
+    def to_json(self, **kwargs) -> str:
+        """Returns to_dict() as JSON. Keyword arguments are passed to json.dumps."""
+        import json
+
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix="llm_completion") -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for counter in self.COUNTERS:
+                lines.append(f"# HELP {prefix}_{counter}_total Completion {counter.replace('_', ' ')}.")
+                lines.append(f"# TYPE {prefix}_{counter}_total counter")
+                for dimension, name, series in self._iter_series():
+                    labels = _format_prometheus_labels({dimension: name})
+                    lines.append(f"{prefix}_{counter}_total{labels} {series['counters'][counter]}")
+            for metric in self.HISTOGRAMS:
+                lines.append(f"# HELP {prefix}_{metric} Completion {metric.replace('_', ' ')}.")
+                lines.append(f"# TYPE {prefix}_{metric} histogram")
+                for dimension, name, series in self._iter_series():
+                    histogram = series["histograms"][metric]
+                    for bound, count in histogram.cumulative_counts():
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        labels = _format_prometheus_labels({dimension: name, "le": le})
+                        lines.append(f"{prefix}_{metric}_bucket{labels} {count}")
+                    labels = _format_prometheus_labels({dimension: name})
+                    lines.append(f"{prefix}_{metric}_sum{labels} {histogram.sum}")
+                    lines.append(f"{prefix}_{metric}_count{labels} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _iter_series(self):
+        for dimension, by_name in self._series.items():
+            for name, series in by_name.items():
+                yield dimension, name, series
+
+
+def _format_prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a model's circuit breaker is open and requests are failing fast."""
+
+
+class _TokenBucket:
+    """A token bucket refilled continuously at `rate_per_minute`, holding at most one minute's worth."""
+
+    def __init__(self, rate_per_minute, now):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.rate_per_second = rate_per_minute / 60.0
+        self.updated_at = now
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` tokens are available (0 if they are available now)."""
+        self.refill(now)
+        # A request larger than the bucket is admitted once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate_per_second
+
+    def consume(self, amount):
+        # May go negative when a response used more tokens than estimated
+        self.tokens -= amount
+
+
+class _ModelLane:
+    """The admission queue, rate limits and circuit breaker state of one model."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, now):
+        self.waiting = []  # heap of (priority, sequence)
+        # Futures of the event loop tasks waiting for admission, by their waiting entry
+        self.async_waiters = {}
+        self.in_flight = 0
+        self.requests = (
+            _TokenBucket(requests_per_minute, now) if requests_per_minute else None
+        )
+        self.tokens = _TokenBucket(tokens_per_minute, now) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+
+    def wait_time(self, estimated_tokens, now):
+        wait = self.blocked_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(estimated_tokens, now))
+        return max(0.0, wait)
+
+    def consume(self, estimated_tokens):
+        if self.requests is not None:
+            self.requests.consume(1)
+        if self.tokens is not None:
+            self.tokens.consume(estimated_tokens)
+
+
+class CompletionScheduler:
+    """Admits, rate limits and retries chat completion requests.
+
+    Each model gets its own lane with:
+
+    - token buckets for requests per minute and tokens per minute,
+    - a priority queue, so that waiting INTERACTIVE requests are admitted before BULK ones,
+    - a circuit breaker that fails fast after `failure_threshold` consecutive failures,
+      and lets a single trial request through once `reset_timeout` has passed.
+
+    Retryable failures (429, 408, 409, 5xx, connection errors and timeouts) are retried
+    with jittered exponential backoff. A Retry-After header takes precedence over the
+    computed delay and holds back the whole lane, not just the failed request.
+
+    The openai client retries on its own too. do_chat_completion and its variants send
+    requests through a copy of the client with `max_retries=0`, so that the scheduler sees
+    every failure and retries do not multiply.
+
+    Args:
+        requests_per_minute (int, optional): Request rate limit per model. Unlimited if None.
+        tokens_per_minute (int, optional): Token rate limit per model. Unlimited if None.
+        max_concurrency (int, optional): In-flight request limit per model. Unlimited if None.
+        max_retries (int): How often a failed request is retried.
+        base_delay (float): The backoff delay of the first retry, in seconds.
+        max_delay (float): Upper bound on the computed backoff delay, in seconds.
+        failure_threshold (int): Consecutive failures that open a model's circuit.
+        reset_timeout (float): Seconds an open circuit waits before a trial request.
+        clock: A callable returning monotonic seconds. Injectable for tests.
+        sleep: A callable sleeping for the given seconds. Injectable for tests; `acall`
+            then uses it too instead of asyncio.sleep.
+        rng: A random.Random used for the backoff jitter.
+
+    Examples:
+        >>> fake_time = [0.0]
+        >>> scheduler = CompletionScheduler(
+        ...     max_retries=2,
+        ...     clock=lambda: fake_time[0],
+        ...     sleep=lambda seconds: fake_time.__setitem__(0, fake_time[0] + seconds),
+        ... )
+        >>> class RateLimited(Exception):
+        ...     status_code = 429
+        >>> attempts = []
+        >>> def flaky_request():
+        ...     attempts.append(fake_time[0])
+        ...     if len(attempts) < 3:
+        ...         raise RateLimited()
+        ...     return "ok"
+        >>> scheduler.call(flaky_request, model="gpt-4.1-nano")
+        'ok'
+        >>> len(attempts)
+        3
+    """
+
+    RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_concurrency=None,
+        max_retries=4,
+        base_delay=0.5,
+        max_delay=30.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        clock=None,
+        sleep=None,
+        rng=None,
+    ):
+        import random
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock or time.monotonic
+        self._sleep = sleep or time.sleep
+        self._rng = rng or random.Random()
+        self._condition = threading.Condition()
+        self._lanes = {}
+        self._sequence = itertools.count()
+
+    def call(self, fn, model, priority=Priority.NORMAL, estimated_tokens=0, on_retry=None):
+        """Runs `fn` once admitted, retrying retryable failures.
+
+        Args:
+            fn: A callable making the request and returning the response.
+            model: The model the request goes to. Lanes are kept per model.
+            priority (Priority): The admission priority of the request.
+            estimated_tokens (int): The expected prompt plus completion tokens, charged to
+                the tokens-per-minute bucket before the request and corrected with the
+                response's actual usage afterwards.
+            on_retry: An optional callback receiving the retry number before each retry.
+
+        Returns:
+            The return value of `fn`.
+
+        Raises:
+            CircuitOpenError: If the model's circuit is open.
+            Exception: The last error of `fn` if it is not retryable or retries ran out.
+        """
+        lane = self._get_lane(model)
+        attempt = 0
+        while True:
+            self._acquire(lane, model, priority, estimated_tokens)
+            try:
+                response = fn()
+            except Exception as e:
+                delay = self._handle_failure(lane, e, attempt)
+            else:
+                self._handle_success(lane, response, estimated_tokens)
+                return response
+            finally:
+                self._release(lane)
+            attempt += 1
+            if on_retry is not None:
+                on_retry(attempt)
+            self._sleep(delay)
+
+    async def acall(self, fn, model, priority=Priority.NORMAL, estimated_tokens=0, on_retry=None):
+        """The async counterpart of `call`, for a `fn` returning an awaitable.
+
+        Queued requests wait on event loop futures and rate limit and backoff waits use
+        asyncio.sleep, so a queued request costs no thread and can be cancelled at any point.
+        """
+        lane = self._get_lane(model)
+        attempt = 0
+        while True:
+            await self._aacquire(lane, model, priority, estimated_tokens)
+            try:
+                response = await fn()
+            except Exception as e:
+                delay = self._handle_failure(lane, e, attempt)
+            else:
+                self._handle_success(lane, response, estimated_tokens)
+                return response
+            finally:
+                self._release(lane)
+            attempt += 1
+            if on_retry is not None:
+                on_retry(attempt)
+            await self._asleep(delay)
+
+    async def _aacquire(self, lane, model, priority, estimated_tokens):
+        loop = asyncio.get_running_loop()
+        entry = self._enqueue(lane, model, priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_admit(lane, entry, estimated_tokens)
+                    if wait is None:
+                        # Registered under the lock, so a release cannot slip in before the await
+                        wakeup = loop.create_future()
+                        lane.async_waiters[entry] = wakeup
+                if wait is None:
+                    await wakeup
+                elif wait <= 0:
+                    return
+                else:
+                    # Stays at the head of the queue, like the sync waiters
+                    await self._asleep(wait)
+        except BaseException:
+            self._dequeue(lane, entry)
+            raise
+
+    async def _asleep(self, seconds):
+        if self._sleep is time.sleep:
+            await asyncio.sleep(seconds)
+        else:
+            self._sleep(seconds)
+
+    def is_open(self, model) -> bool:
+        """Whether the circuit of `model` is open (failing fast)."""
+        lane = self._get_lane(model)
+        with self._condition:
+            return self._circuit_rejects(lane, self._clock())
+
+    def _get_lane(self, model):
+        key = getattr(model, "value", model)
+        with self._condition:
+            if key not in self._lanes:
+                self._lanes[key] = _ModelLane(
+                    self.requests_per_minute, self.tokens_per_minute, self._clock()
+                )
+            return self._lanes[key]
+
+    def _circuit_rejects(self, lane, now):
+        if lane.opened_at is None:
+            return False
+        if now - lane.opened_at < self.reset_timeout or lane.half_open_trial:
+            return True
+        # Half-open: let one trial request through
+        lane.half_open_trial = True
+        return False
+
+    def _acquire(self, lane, model, priority, estimated_tokens):
+        entry = self._enqueue(lane, model, priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_admit(lane, entry, estimated_tokens)
+                    while wait is None:
+                        self._condition.wait()
+                        wait = self._try_admit(lane, entry, estimated_tokens)
+                if wait <= 0:
+                    return
+                # Sleep outside the lock while staying at the head of the queue. A higher
+                # priority request arriving meanwhile takes the head and goes first.
+                self._sleep(wait)
+        except BaseException:
+            self._dequeue(lane, entry)
+            raise
+
+    def _enqueue(self, lane, model, priority):
+        """Adds a waiting entry to the lane's queue, or raises CircuitOpenError."""
+        with self._condition:
+            if self._circuit_rejects(lane, self._clock()):
+                raise CircuitOpenError(
+                    f"Circuit for {getattr(model, 'value', model)} is open after "
+                    f"{lane.consecutive_failures} consecutive failures."
+                )
+            entry = (int(priority), next(self._sequence))
+            heapq.heappush(lane.waiting, entry)
+            return entry
+
+    def _dequeue(self, lane, entry):
+        """Removes a waiting entry that gave up before being admitted."""
+        with self._condition:
+            lane.async_waiters.pop(entry, None)
+            if entry in lane.waiting:
+                lane.waiting.remove(entry)
+                heapq.heapify(lane.waiting)
+                self._notify_waiters(lane)
+
+    def _try_admit(self, lane, entry, estimated_tokens):
+        """Admits entry if it can go now. Call with the lock held.
+
+        Returns:
+            None while entry must wait for another request, 0 once it was admitted, or the
+            seconds to wait for the rate limits while staying at the head of the queue.
+        """
+        if lane.waiting[0] != entry or (
+            self.max_concurrency is not None and lane.in_flight >= self.max_concurrency
+        ):
+            return None
+        wait = lane.wait_time(estimated_tokens, self._clock())
+        if wait > 0:
+            return wait
+        heapq.heappop(lane.waiting)
+        lane.consume(estimated_tokens)
+        lane.in_flight += 1
+        self._notify_waiters(lane)
+        return 0.0
+
+    def _notify_waiters(self, lane):
+        """Wakes the threads and event loop tasks waiting for admission. Call with the lock held."""
+        self._condition.notify_all()
+        for wakeup in lane.async_waiters.values():
+            loop = wakeup.get_loop()
+            # The waiters may live on other event loops than the caller's, or on none
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_resolve_wakeup, wakeup)
+        lane.async_waiters.clear()
+
+    def _release(self, lane):
+        with self._condition:
+            lane.in_flight -= 1
+            self._notify_waiters(lane)
+
+    def _handle_success(self, lane, response, estimated_tokens):
+        usage = getattr(response, "usage", None)
+        total_tokens = getattr(usage, "total_tokens", None)
+        with self._condition:
+            lane.consecutive_failures = 0
+            lane.opened_at = None
+            lane.half_open_trial = False
+            if lane.tokens is not None and isinstance(total_tokens, int):
+                lane.tokens.consume(total_tokens - estimated_tokens)
+
+    def _handle_failure(self, lane, error, attempt):
+        """Records a failed attempt and returns the delay before the retry, or re-raises."""
+        if not self._is_retryable(error):
+            with self._condition:
+                lane.half_open_trial = False
+            raise error
+        now = self._clock()
+        retry_after = _get_retry_after(error)
+        with self._condition:
+            lane.consecutive_failures += 1
+            if lane.half_open_trial or lane.consecutive_failures >= self.failure_threshold:
+                lane.opened_at = now
+            lane.half_open_trial = False
+            if retry_after is not None:
+                lane.blocked_until = max(lane.blocked_until, now + retry_after)
+        if attempt >= self.max_retries:
+            raise error
+        if retry_after is not None:
+            return retry_after
+        # Full jitter keeps retries of concurrent requests from arriving in lockstep
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _is_retryable(self, error):
+        status_code = getattr(error, "status_code", None)
+        if isinstance(status_code, int):
+            return status_code in self.RETRYABLE_STATUS_CODES or status_code >= 500
+        try:
+            from openai import APIConnectionError
+        except ImportError:
+            return isinstance(error, (ConnectionError, TimeoutError))
+        return isinstance(error, (APIConnectionError, ConnectionError, TimeoutError))
+
+
+def _resolve_wakeup(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _get_retry_after(error):
+    """Returns the Retry-After delay of an API error in seconds, if the response has one."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _estimate_request_tokens(messages, kwargs):
+    """A rough prompt plus completion token estimate, for charging the tokens-per-minute bucket."""
+    prompt_chars = sum(
+        len(str(message.get("content") or "")) + len(str(message.get("tool_calls") or ""))
+        for message in messages
+    )
+    max_completion_tokens = (
+        kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or 0
+    )
+    return prompt_chars // 4 + 4 * len(messages) + max_completion_tokens
+
+
+_COMPLETION_SCHEDULER = None
+
+
+def get_completion_scheduler() -> CompletionScheduler:
+    """Returns the process-wide completion scheduler, creating a default one on first use.
+
+    The default scheduler retries and circuit-breaks but applies no rate or concurrency
+    limits. Use set_completion_scheduler to install one configured for your account limits.
+    """
+    global _COMPLETION_SCHEDULER
+    if _COMPLETION_SCHEDULER is None:
+        _COMPLETION_SCHEDULER = CompletionScheduler()
+    return _COMPLETION_SCHEDULER
+
+
+def set_completion_scheduler(scheduler: CompletionScheduler | None):
+    """Replaces the process-wide completion scheduler.
+
+    Args:
+        scheduler: The new scheduler, or None to go back to the default one.
+    """
+    global _COMPLETION_SCHEDULER
+    _COMPLETION_SCHEDULER = scheduler
+
+
+def _get_request_priority(priority):
+    """Requests without an explicit priority are BULK inside an evaluation, NORMAL otherwise."""
+    if priority is not None:
+        return priority
+    return Priority.BULK if _CURRENT_EVAL_NAME.get() is not None else Priority.NORMAL
+
+
+# Defaults of the shared OpenAI clients; see configure_openai_clients
+_OPENAI_CLIENT_CONFIG = {
+    "base_url": None,
+    "api_key": None,
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 60.0,
+    "timeout": 120.0,
+    "connect_timeout": 10.0,
+    "http2": None,
+    # The CompletionScheduler does the retrying, so it sees every failure
+    "max_retries": 0,
+}
+
+_OPENAI_CLIENTS = {}
+_OPENAI_CLIENTS_LOCK = threading.Lock()
+
+
+def configure_openai_clients(**options):
+    """Changes the settings of the clients handed out by get_openai_client.
+
+    Clients created before the call keep their settings but are no longer handed out.
+
+    Args:
+        base_url (str): The API base URL used when get_openai_client is called without
+            one. Falls back to the OPENAI_BASE_URL environment variable, then the OpenAI API.
+        api_key (str): The API key used when get_openai_client is called without one.
+            Falls back to the OPENAI_API_KEY environment variable.
+        max_connections (int): Connection pool size per client.
+        max_keepalive_connections (int): Idle connections kept open per client.
+        keepalive_expiry (float): Seconds an idle connection is kept open.
+        timeout (float): Read, write and pool timeout in seconds.
+        connect_timeout (float): Connect timeout in seconds.
+        http2 (bool): Whether to use HTTP/2. By default it is used when the `h2` package
+            is installed.
+        max_retries (int): Retries made by the client itself. 0 by default, since the
+            CompletionScheduler retries.
+
+    Raises:
+        TypeError: If an unknown option is passed.
+    """
+    unknown_options = set(options) - set(_OPENAI_CLIENT_CONFIG)
+    if unknown_options:
+        raise TypeError(f"Unknown client options: {', '.join(sorted(unknown_options))}")
+    with _OPENAI_CLIENTS_LOCK:
+        _OPENAI_CLIENT_CONFIG.update(options)
+        _OPENAI_CLIENTS.clear()
+
+
+def get_openai_client(base_url=None, api_key=None, async_client=False):
+    """Returns the shared, connection-pooled OpenAI client for a base URL and API key.
+
+    One client is kept per (base_url, api_key, sync/async), so every agent and eval
+    reuses the same keep-alive connections instead of paying for new TLS handshakes.
+    HTTP/2 is used when the `h2` package is installed.
+
+    Args:
+        base_url (str, optional): The API base URL. Defaults to the configured one.
+        api_key (str, optional): The API key. Defaults to the configured one.
+        async_client (bool): Whether to return an `openai.AsyncOpenAI` client. Async
+            clients must only be used on one event loop.
+
+    Returns:
+        openai.OpenAI | openai.AsyncOpenAI: The shared client.
+
+    Raises:
+        openai.OpenAIError: If no API key is given, configured or set in the environment.
+    """
+    import os
+
+    with _OPENAI_CLIENTS_LOCK:
+        config = dict(_OPENAI_CLIENT_CONFIG)
+        base_url = base_url or config["base_url"] or os.getenv("OPENAI_BASE_URL")
+        api_key = api_key or config["api_key"] or os.getenv("OPENAI_API_KEY")
+        key = (base_url, api_key, async_client)
+        if key not in _OPENAI_CLIENTS:
+            _OPENAI_CLIENTS[key] = _create_openai_client(base_url, api_key, async_client, config)
+        return _OPENAI_CLIENTS[key]
+
+
+def _create_openai_client(base_url, api_key, async_client, config):
+    import importlib.util
+
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+    http2 = config["http2"]
+    if http2 is None:
+        http2 = importlib.util.find_spec("h2") is not None
+    http_client_options = dict(
+        limits=httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_keepalive_connections"],
+            keepalive_expiry=config["keepalive_expiry"],
+        ),
+        timeout=httpx.Timeout(config["timeout"], connect=config["connect_timeout"]),
+        http2=http2,
+    )
+    if async_client:
+        return AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            max_retries=config["max_retries"],
+            http_client=DefaultAsyncHttpxClient(**http_client_options),
+        )
+    return OpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        max_retries=config["max_retries"],
+        http_client=DefaultHttpxClient(**http_client_options),
+    )
+
+
+def estimate_completion_cost(model, prompt_tokens, completion_tokens, cached_tokens=0) -> float:
+    """Estimates the USD cost of a completion from MODEL_PRICES_PER_MILLION_TOKENS.
+
+    Args:
+        model (OpenAIModel | str): The model.
+        prompt_tokens (int): All prompt tokens, including the cached ones.
+        completion_tokens (int): Completion tokens.
+        cached_tokens (int): The part of the prompt tokens served from the prompt cache.
+
+    Returns:
+        float: The estimated cost, or 0.0 for a model without a known price.
+
+    Examples:
+        >>> round(estimate_completion_cost(OpenAIModel.GPT_41, 1_000_000, 100_000), 2)
+        2.8
+    """
+    prices = MODEL_PRICES_PER_MILLION_TOKENS.get(getattr(model, "value", model))
+    if prices is None:
+        return 0.0
+    return (
+        (prompt_tokens - cached_tokens) * prices["input"]
+        + cached_tokens * prices["cached_input"]
+        + completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+def extract_verdict(text, verdicts):
+    """Returns the verdict token a response settles on, or None if it does not settle on one.
+
+    Only the part after the last "FINAL ANSWER:" or "FINAL OUTPUT:" marker is considered
+    when the response has one, since the reasoning before it may mention every verdict.
+
+    Args:
+        text (str): The model response.
+        verdicts (list[str]): The expected verdict tokens, e.g. IS_COMPATIBLE and IS_INCOMPATIBLE.
+
+    Returns:
+        str | None: The only verdict in the answer, or None if none or several are present.
+
+    Examples:
+        >>> extract_verdict("REASONING: not IS_INCOMPATIBLE\\nFINAL ANSWER:\\nIS_COMPATIBLE", ["IS_COMPATIBLE", "IS_INCOMPATIBLE"])
+        'IS_COMPATIBLE'
+        >>> extract_verdict("IS_COMPATIBLE or IS_INCOMPATIBLE", ["IS_COMPATIBLE", "IS_INCOMPATIBLE"]) is None
+        True
+    """
+    import re
+
+    text = text or ""
+    answer = re.split(r"FINAL (?:ANSWER|OUTPUT):", text)[-1]
+    found = {
+        verdict
+        for verdict in verdicts
+        if re.search(rf"(?<![A-Z_]){re.escape(verdict)}(?![A-Z_])", answer)
+    }
+    return found.pop() if len(found) == 1 else None
+
+
+class ModelCascade:
+    """Routes classification prompts to the cheapest model tier that answers them reliably.
+
+    Each tier but the last is sampled `samples` times. Its answer is accepted when every
+    sample settles on the same expected verdict token; an unparseable answer or a
+    disagreement between samples escalates to the next tier. The last tier is trusted
+    with a single sample.
+
+    The cascade keeps per-eval statistics (see `report`), comparing the cost and latency
+    of the cascade with sending every request to the last tier.
+
+    Args:
+        tiers (list[OpenAIModel]): Models from cheapest to most capable.
+        samples (int): Samples per request on every tier but the last, for the
+            self-consistency check. 1 disables the check.
+        client (OpenAI, optional): The client. Defaults to the shared client of get_openai_client.
+        cache (ResponseCache, optional): Caches the first sample of each tier.
+
+    Examples:
+        >>> from types import SimpleNamespace
+        >>> from unittest.mock import patch
+        >>> answers = {"gpt-4.1-nano": ["IS_COMPATIBLE", "IS_INCOMPATIBLE"], "gpt-4.1-mini": ["IS_COMPATIBLE"] * 2}
+        >>> def fake_completion(messages, model, **kwargs):
+        ...     return answers[model.value].pop()
+        >>> cascade = ModelCascade(samples=2)
+        >>> with patch("utils.do_chat_completion", fake_completion):
+        ...     cascade.classify([{"role": "user", "content": "..."}], ["IS_COMPATIBLE", "IS_INCOMPATIBLE"])
+        ('IS_COMPATIBLE', 'IS_COMPATIBLE')
+        >>> cascade.report()["unknown"]["resolved_by"]
+        {'gpt-4.1-mini': 1}
+    """
+
+    def __init__(
+        self,
+        tiers=(OpenAIModel.GPT_41_NANO, OpenAIModel.GPT_41_MINI, OpenAIModel.GPT_41),
+        samples=2,
+        client=None,
+        cache=None,
+    ):
+        self.tiers = list(tiers)
+        self.samples = samples
+        self.client = client
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_tier_latencies = []
+
+    def classify(self, messages, verdicts, start_tier=None, **kwargs):
+        """Answers a prompt that must end in one of `verdicts`, escalating as needed.
+
+        Args:
+            messages (list[dict]): The chat messages.
+            verdicts (list[str]): The expected verdict tokens.
+            start_tier (OpenAIModel, optional): The tier to start on, for judgments the
+                cheaper tiers are known to get wrong. Defaults to the first tier.
+            **kwargs: Passed on to do_chat_completion.
+
+        Returns:
+            tuple[str | None, str]: The verdict and the response it was read from. The
+            verdict is None when even the last tier's answer could not be parsed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        start_index = self.tiers.index(start_tier) if start_tier is not None else 0
+        usage_by_model = {}
+        start = time.perf_counter()
+        verdict = response = None
+        for tier_index, model in enumerate(self.tiers):
+            if tier_index < start_index:
+                continue
+            is_last_tier = tier_index == len(self.tiers) - 1
+            samples = 1 if is_last_tier else self.samples
+            tier_start = time.perf_counter()
+
+            def sample(sample_index, model=model):
+                return do_chat_completion(
+                    messages,
+                    model=model,
+                    client=self.client,
+                    # Repeated samples of the same request must not be served from the cache
+                    cache=self.cache if sample_index == 0 else None,
+                    on_usage=usage_by_model.setdefault(model, []).append,
+                    **kwargs,
+                )
+
+            if samples == 1:
+                responses = [sample(0)]
+            else:
+                # The samples keep the eval name, so metrics and scheduler priority see them
+                with ThreadPoolExecutor(max_workers=samples) as executor:
+                    futures = [
+                        executor.submit(contextvars.copy_context().run, sample, sample_index)
+                        for sample_index in range(samples)
+                    ]
+                    responses = [future.result() for future in futures]
+
+            if is_last_tier:
+                with self._lock:
+                    self._last_tier_latencies.append(time.perf_counter() - tier_start)
+
+            sample_verdicts = {extract_verdict(resp, verdicts) for resp in responses}
+            verdict, response = extract_verdict(responses[0], verdicts), responses[0]
+            if is_last_tier or (len(sample_verdicts) == 1 and verdict is not None):
+                break
+
+        self._record(model, usage_by_model, time.perf_counter() - start, start_index)
+        return verdict, response
+
+    def _record(self, resolved_by, usage_by_model, latency, start_index=0):
+        cost = baseline_cost = 0.0
+        for model, usages in usage_by_model.items():
+            for usage in usages:
+                prompt_tokens, cached_tokens, completion_tokens = _get_usage_tokens(usage)
+                cost += estimate_completion_cost(
+                    model, prompt_tokens, completion_tokens, cached_tokens
+                )
+        # The baseline sends the same prompt to the last tier once
+        first_usages = next((usages for usages in usage_by_model.values() if usages), [])
+        if first_usages:
+            prompt_tokens, _, completion_tokens = _get_usage_tokens(first_usages[0])
+            baseline_cost = estimate_completion_cost(self.tiers[-1], prompt_tokens, completion_tokens)
+
+        eval_name = _CURRENT_EVAL_NAME.get() or "unknown"
+        with self._lock:
+            stats = self._stats.setdefault(
+                eval_name,
+                {
+                    "requests": 0,
+                    "escalations": 0,
+                    "resolved_by": {},
+                    "cost_usd": 0.0,
+                    "baseline_cost_usd": 0.0,
+                    "latency_s": 0.0,
+                },
+            )
+            stats["requests"] += 1
+            stats["escalations"] += self.tiers.index(resolved_by) - start_index
+            model_name = getattr(resolved_by, "value", resolved_by)
+            stats["resolved_by"][model_name] = stats["resolved_by"].get(model_name, 0) + 1
+            stats["cost_usd"] += cost
+            stats["baseline_cost_usd"] += baseline_cost
+            stats["latency_s"] += latency
+
+    def report(self) -> dict:
+        """Returns the cost and latency of the cascade per eval, next to its last-tier-only baseline.
+
+        The baseline cost prices each request's prompt and completion tokens at the last
+        tier's rates. The baseline latency multiplies the request count by the mean
+        latency observed on the last tier, and is None until the last tier has been used.
+
+        Returns:
+            dict: Per eval name: requests, escalations, resolved_by (requests per model),
+            cost_usd, baseline_cost_usd, cost_savings_usd, latency_s, baseline_latency_s
+            and latency_savings_s.
+        """
+        with self._lock:
+            mean_last_tier_latency = (
+                sum(self._last_tier_latencies) / len(self._last_tier_latencies)
+                if self._last_tier_latencies
+                else None
+            )
+            report = {}
+            for eval_name, stats in self._stats.items():
+                baseline_latency = (
+                    stats["requests"] * mean_last_tier_latency
+                    if mean_last_tier_latency is not None
+                    else None
+                )
+                report[eval_name] = {
+                    **stats,
+                    "resolved_by": dict(stats["resolved_by"]),
+                    "cost_savings_usd": stats["baseline_cost_usd"] - stats["cost_usd"],
+                    "baseline_latency_s": baseline_latency,
+                    "latency_savings_s": (
+                        baseline_latency - stats["latency_s"] if baseline_latency is not None else None
+                    ),
+                }
+            return report
+
+
+def get_tool_schemas(tools) -> list[dict]:
+    """Returns the OpenAI function-calling schemas of tools.
+
+    Args:
+        tools (list): Functions, or tool schemas which are passed through unchanged.
+
+    Returns:
+        list[dict]: One {"type": "function", "function": {...}} schema per tool.
+    """
+    return [tool if isinstance(tool, dict) else get_tool_schema(tool) for tool in tools]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_schema(fn) -> dict:
+    """Builds the OpenAI function-calling schema of a function.
+
+    The description is the docstring up to its Args section, the same text
+    `get_tool_descriptions_string` shows. Parameter types come from the annotations, or
+    from the "name (type): description" lines of the Args section for unannotated
+    parameters, and Pydantic models are expanded into their JSON schema.
+
+    Args:
+        fn (callable): The tool function.
+
+    Returns:
+        dict: The tool schema.
+
+    Examples:
+        >>> def add_tool(a: int, b=1):
+        ...     '''Adds two numbers.
+        ...
+        ...     Args:
+        ...         a (int): The first number.
+        ...         b (int): The second number.
+        ...     '''
+        >>> schema = get_tool_schema(add_tool)["function"]
+        >>> schema["description"], schema["parameters"]["required"]
+        ('Adds two numbers.', ['a'])
+        >>> schema["parameters"]["properties"]["b"]
+        {'default': 1, 'description': 'The second number.', 'type': 'integer'}
+    """
+    import inspect
+    import typing
+
+    from pydantic import Field, create_model
+
+    description, documented_args = _parse_tool_docstring(fn.__doc__ or "")
+    type_hints = typing.get_type_hints(fn)
+    fields = {}
+    for name, parameter in inspect.signature(fn).parameters.items():
+        if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+        documented_type, arg_description = documented_args.get(name, (None, None))
+        annotation = type_hints.get(
+            name, _DOCSTRING_TYPES.get(documented_type, typing.Any)
+        )
+        default = ... if parameter.default is parameter.empty else parameter.default
+        fields[name] = (annotation, Field(default, description=arg_description))
+
+    parameters = create_model(fn.__name__, **fields).model_json_schema()
+    parameters.pop("title", None)
+    for property_schema in parameters.get("properties", {}).values():
+        property_schema.pop("title", None)
+    parameters.setdefault("required", [])
+    return {
+        "type": "function",
+        "function": {
+            "name": fn.__name__,
+            "description": description or "No description provided.",
+            "parameters": parameters,
+        },
+    }
+
+
+_DOCSTRING_TYPES = {"str": str, "int": int, "float": float, "bool": bool, "list": list, "dict": dict}
+
+_DOCSTRING_SECTIONS = ("Args:", "Returns:", "Raises:", "Example:", "Examples:", "Yields:")
+
+
+def _parse_tool_docstring(docstring):
+    """Splits a Google-style docstring into its description and documented arguments.
+
+    Returns:
+        tuple: The description and {name: (type, description)} of the Args section.
+    """
+    import inspect
+    import re
+
+    description_lines = []
+    documented_args = {}
+    section = None
+    current_arg = None
+    for line in inspect.cleandoc(docstring).splitlines():
+        stripped = line.strip()
+        if stripped in _DOCSTRING_SECTIONS:
+            section = stripped
+            continue
+        if section is None:
+            description_lines.append(stripped)
+        elif section == "Args:" and stripped:
+            match = re.match(r"^(\w+)\s*(?:\(([^)]*)\))?\s*:\s*(.*)$", stripped)
+            if match and not line.startswith(" " * 8):
+                current_arg = match.group(1)
+                documented_args[current_arg] = (match.group(2), match.group(3))
+            elif current_arg is not None:
+                arg_type, arg_description = documented_args[current_arg]
+                documented_args[current_arg] = (arg_type, f"{arg_description} {stripped}")
+    return " ".join(line for line in description_lines if line), documented_args
+
+
+class ToolExecutor:
+    """Runs the tools of a ReAct agent by name, with memoization and timeouts.
+
+    The name→callable registry is built once. Results of pure tools (tools whose response
+    depends only on their arguments) are memoized on the canonical JSON of their
+    arguments, so dict key order and equal Pydantic models share a cache entry. Several
+    tool calls can run concurrently in a thread pool with `call_many`.
+
+    A tool that times out keeps running in its worker thread, since Python threads cannot
+    be interrupted; a pure tool that finishes late still fills the cache.
+
+    Args:
+        tools (list[callable]): The tools, registered under their __name__.
+        pure_tools (list, optional): The tools (or their names) whose results may be memoized.
+        timeout (float, optional): Seconds to wait for a tool before giving up on it.
+            None waits indefinitely.
+        timeouts (dict, optional): Per-tool timeouts by tool name, overriding `timeout`.
+        max_workers (int): The size of the thread pool used for concurrent calls.
+        cache_size (int): The most memoized results to keep, least recently used first out.
+
+    Examples:
+        >>> def add_tool(a, b):
+        ...     return a + b
+        >>> executor = ToolExecutor([add_tool], pure_tools=[add_tool])
+        >>> executor.call("add_tool", {"a": 1, "b": 2}), executor.call("add_tool", {"b": 2, "a": 1})
+        (3, 3)
+        >>> executor.stats()["cache_hits"]
+        1
+    """
+
+    def __init__(
+        self,
+        tools,
+        pure_tools=(),
+        timeout=None,
+        timeouts=None,
+        max_workers=8,
+        cache_size=256,
+    ):
+        self.tools = {tool.__name__: tool for tool in tools}
+        self.pure_tools = {
+            tool if isinstance(tool, str) else tool.__name__ for tool in pure_tools
+        }
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._stats = {"calls": 0, "cache_hits": 0, "timeouts": 0, "errors": 0}
+
+    def get(self, tool_name):
+        """Returns the tool registered under tool_name, or None."""
+        return self.tools.get(tool_name)
+
+    def call(self, tool_name, arguments):
+        """Calls a tool with keyword arguments.
+
+        Args:
+            tool_name (str): The name of the tool.
+            arguments (dict): The keyword arguments of the call.
+
+        Returns:
+            The tool's response.
+
+        Raises:
+            KeyError: If no tool is registered under tool_name.
+            TimeoutError: If the tool does not respond within its timeout.
+            Exception: Whatever the tool raises.
+        """
+        return self._get_outcome(self._submit(tool_name, arguments))
+
+    def call_many(self, tool_calls):
+        """Calls several tools concurrently.
+
+        Args:
+            tool_calls (list[tuple]): (tool name, arguments) per call.
+
+        Returns:
+            list[tuple]: (response, None) or (None, exception) per call, in the order of
+            tool_calls.
+        """
+        # A call that cannot even start (e.g. an unknown tool) fails alone, not the batch
+        pending = []
+        for tool_name, arguments in tool_calls:
+            try:
+                pending.append((self._submit(tool_name, arguments), None))
+            except Exception as e:
+                pending.append((None, e))
+        outcomes = []
+        for call, error in pending:
+            if error is not None:
+                outcomes.append((None, error))
+                continue
+            try:
+                outcomes.append((self._get_outcome(call), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def clear_cache(self):
+        """Forgets every memoized result."""
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        """Returns the number of calls, cache hits, timeouts and errors so far."""
+        with self._lock:
+            return {**self._stats, "cache_entries": len(self._cache)}
+
+    def close(self):
+        """Shuts down the thread pool, without waiting for tools that timed out."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _submit(self, tool_name, arguments):
+        """Starts a call and returns (tool name, deadline, future or memoized response)."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        tool_fn = self.tools.get(tool_name)
+        if tool_fn is None:
+            raise KeyError(f"Unknown tool name '{tool_name}'")
+
+        key = None
+        with self._lock:
+            self._stats["calls"] += 1
+            if tool_name in self.pure_tools:
+                key = (tool_name, _canonicalize_tool_arguments(arguments))
+                if key in self._cache:
+                    self._stats["cache_hits"] += 1
+                    self._cache.move_to_end(key)
+                    return tool_name, None, self._cache[key], False
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="tool"
+                )
+            pool = self._pool
+
+        timeout = self.timeouts.get(tool_name, self.timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        return tool_name, deadline, pool.submit(self._run, tool_fn, arguments, key), True
+
+    def _run(self, tool_fn, arguments, key):
+        response = tool_fn(**arguments)
+        if key is not None:
+            with self._lock:
+                self._cache[key] = response
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return response
+
+    def _get_outcome(self, call):
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+
+        tool_name, deadline, value, is_future = call
+        if not is_future:
+            return value
+        try:
+            return value.result(
+                timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            )
+        except FutureTimeoutError:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"Tool {tool_name} did not respond in time") from None
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+
+
+def _canonicalize_tool_arguments(arguments):
+    import json
+
+    def canonicalize(value):
+        if isinstance(value, Enum):
+            return value.value
+        if hasattr(value, "model_dump"):
+            return value.model_dump(mode="json")
+        return str(value)
+
+    return json.dumps(arguments, sort_keys=True, separators=(",", ":"), default=canonicalize)
+
+
+def split_prompt_template(template, static_values=None, volatile_values=None):
+    """Splits a prompt template into a stable prefix and a volatile suffix.
+
+    Providers cache prompts by exact prefix. Interpolating per-conversation data into the
+    middle of a system prompt means nothing after the first volatile value can ever be
+    served from the cache. This formats the template with the static values and leaves
+    a short reference where each volatile value was, then collects the volatile values
+    into a separate context block meant to be sent after the static prompt.
+
+    Args:
+        template (str): A str.format template.
+        static_values (dict, optional): Values that are the same for every conversation.
+        volatile_values (dict, optional): Per-conversation values.
+
+    Returns:
+        tuple[str, str]: The static prefix and the volatile suffix.
+
+    Examples:
+        >>> prefix, suffix = split_prompt_template(
+        ...     "Plan a trip.\\nSchema: {SCHEMA}\\nWeather: {WEATHER}",
+        ...     static_values={"SCHEMA": "{...}"},
+        ...     volatile_values={"WEATHER": "rainy"},
+        ... )
+        >>> print(prefix)
+        Plan a trip.
+        Schema: {...}
+        Weather: (see WEATHER in the context data below)
+        >>> print(suffix)
+        ## Context Data
+        <BLANKLINE>
+        ### WEATHER
+        rainy
+    """
+    static_values = dict(static_values or {})
+    volatile_values = dict(volatile_values or {})
+
+    static_prefix = template.format(
+        **static_values,
+        **{name: f"(see {name} in the context data below)" for name in volatile_values},
+    )
+    volatile_suffix = "## Context Data\n\n" + "\n\n".join(
+        f"### {name}\n{value}" for name, value in volatile_values.items()
+    )
+    return static_prefix, volatile_suffix
+
+
+def _get_completion_content(response):
+    if hasattr(response, "error"):
+        raise RuntimeError(
+            f"OpenAI API returned an error: {str(response.error)}"
+        )
+
+    return response.choices[0].message.content
+
+
+def _get_completion_message(response):
+    """Returns the assistant message of a response as a chat history dict, tool calls included."""
+    message = response.choices[0].message
+    history_message = {"role": "assistant", "content": message.content}
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        history_message["tool_calls"] = [
+            {
+                "id": tool_call.id,
+                "type": "function",
+                "function": {
+                    "name": tool_call.function.name,
+                    "arguments": tool_call.function.arguments,
+                },
+            }
+            for tool_call in tool_calls
+        ]
+    return history_message
+
+
+def _get_completion_cache_key(cache, messages, model, kwargs, return_message):
+    # Whole messages and bare contents of the same request are cached apart
+    if return_message:
+        kwargs = {**kwargs, "return_message": True}
+    return cache.make_key(messages, model, **kwargs)
+
+
+def _dump_cached_completion(message):
+    import json
+
+    return json.dumps(message)
+
+
+def _load_cached_completion(cached_content, return_message):
+    import json
+
+    return json.loads(cached_content) if return_message else cached_content
+
+
+class ChatHistoryManager:
+    """Keeps a chat history within a token budget.
+
+    When the history exceeds `max_tokens`, it is compacted in three increasingly lossy
+    steps, stopping as soon as it fits:
+
+    1. Travel plan copies superseded by a later plan in the history are replaced by a
+       short placeholder, both in message content and in tool call arguments.
+    2. Old OBSERVATION messages are shortened to `max_observation_chars`, or passed to
+       `summarizer` when one is given.
+    3. The oldest remaining messages are dropped. An assistant message with tool calls
+       is dropped together with the "tool" messages answering it. The first user message,
+       which states the task, is never dropped.
 
-    This class manages chat history, formats system prompts, and handles
-    communication with OpenAI's chat completion API. It provides methods to
-    add messages, get responses, and maintain conversation context.
+    System messages and the last `keep_last_messages` messages are never touched.
+
+    Tokens are counted with tiktoken when it is installed and estimated at four
+    characters per token otherwise.
 
     Attributes:
-        system_prompt_template (str): Template for the system prompt using {variable_name} placeholders.
+        turns (list[dict]): One entry per compaction with tokens_before, tokens_after and
+            tokens_saved.
+
+    Examples:
+        >>> manager = ChatHistoryManager(max_tokens=60, keep_last_messages=1, max_observation_chars=40)
+        >>> messages = [
+        ...     {"role": "system", "content": "You are a helpful assistant."},
+        ...     {"role": "user", "content": "OBSERVATION: " + "x" * 400},
+        ...     {"role": "user", "content": "What next?"},
+        ... ]
+        >>> compacted = manager.compact(messages)
+        >>> compacted[1]["content"]
+        'OBSERVATION: xxxxxxxxxxxxxxxxxxxxxxxxxxx ... [truncated 373 characters]'
+        >>> manager.total_tokens_saved > 0
+        True
     """
-    system_prompt = "You are a helpful assistant."
 
-    def __init__(self, name=None, system_prompt=None, client=None, model=None):
-        self.name = name or self.__class__.__name__
-        # Initialize messages as instance attribute to avoid shared state bug
-        self.messages = []
-        # Use provided system_prompt, or fall back to class attribute (which subclasses can override)
-        self.system_prompt = system_prompt if system_prompt else getattr(self.__class__, 'system_prompt', "You are a helpful assistant.")
-        self.client = client
-        self.model = model
-        self.reset()
+    OBSERVATION_PREFIX = "OBSERVATION:"
+    PLAN_MARKER = '"itinerary_days"'
+    SUPERSEDED_PLAN_PLACEHOLDER = "[Earlier travel plan omitted: superseded by a later version below.]"
+
+    def __init__(
+        self,
+        max_tokens=16_000,
+        keep_last_messages=4,
+        max_observation_chars=1_000,
+        summarizer=None,
+        model=None,
+    ):
+        """
+        Args:
+            max_tokens (int): The token budget for the whole history.
+            keep_last_messages (int): The number of most recent messages left untouched.
+            max_observation_chars (int): The length old observations are truncated to.
+            summarizer (callable, optional): Called with an old observation's text and
+                returns a shorter replacement, e.g. an LLM summary. Truncation is used when omitted.
+            model (str, optional): The model whose tokenizer tiktoken should use.
+        """
+        self.max_tokens = max_tokens
+        self.keep_last_messages = keep_last_messages
+        self.max_observation_chars = max_observation_chars
+        self.summarizer = summarizer
+        self.turns = []
+        self._encoding = None
+        try:
+            import tiktoken
 
-    def add_message(self, role, content):
-        """Add a message to the chat history.
+            try:
+                self._encoding = tiktoken.encoding_for_model(getattr(model, "value", model) or "gpt-4.1")
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            pass
 
-        Args:
-            role (str): The role of the message ("system", "user", or "assistant").
-            content (str): The content of the message.
+    @property
+    def total_tokens_saved(self) -> int:
+        return sum(turn["tokens_saved"] for turn in self.turns)
 
-        Raises:
-            ValueError: If the role is not one of "system", "user", or "assistant".
-        """
-        if role not in ["system", "user", "assistant"]:
-            raise ValueError(f"Invalid role: {role}")
-        self.messages.append({"role": role, "content": content})
-        if role == "system":
-            print_in_box(
-                content,
-                f"{self.name} - System Prompt",
-            )
-        elif role == "user":
-            print_in_box(
-                content,
-                f"{self.name} - User Prompt",
-            )
-        elif role == "assistant":
-            print_in_box(
-                content,
-                f"{self.name} - Assistant Response",
-            )
+    def count_tokens(self, messages) -> int:
+        """Returns the (estimated) number of prompt tokens for messages."""
+        # Every message carries a few tokens of role and separator overhead
+        return sum(self._count_message_tokens(message) for message in messages)
 
-    def reset(self):
-        """Reset the chat history and re-initialize with the system prompt.
+    def compact(self, messages) -> list:
+        """Returns a copy of messages that fits the token budget where possible.
 
-        This method clears all existing messages and adds the system prompt
-        formatted with the template_kwargs.
+        Each call is recorded in `turns`, including the ones that needed no compaction.
         """
-        from textwrap import dedent
-
-        system_prompt = dedent(self.system_prompt).strip()
+        tokens_before = self.count_tokens(messages)
+        messages = [dict(message) for message in messages]
+
+        if tokens_before > self.max_tokens:
+            for compaction_step in (
+                self._drop_superseded_plans,
+                self._shorten_observations,
+                self._drop_oldest_messages,
+            ):
+                messages = compaction_step(messages)
+                if self.count_tokens(messages) <= self.max_tokens:
+                    break
+
+        tokens_after = self.count_tokens(messages)
+        self.turns.append(
+            {
+                "tokens_before": tokens_before,
+                "tokens_after": tokens_after,
+                "tokens_saved": tokens_before - tokens_after,
+            }
+        )
+        return messages
 
-        # Clear previous messages and add the system prompt
-        self.messages = []
-        self.add_message(
-            "system",
-            system_prompt,
+    def _count_message_tokens(self, message) -> int:
+        tokens = self._count_text_tokens(message.get("content") or "") + 4
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self._count_text_tokens(
+                tool_call["function"]["name"] + tool_call["function"]["arguments"]
+            )
+        return tokens
+
+    def _count_text_tokens(self, text) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return (len(text) + 3) // 4
+
+    def _compactable_indexes(self, messages) -> list:
+        """Indexes of the messages that may be changed: not a system message and not in the tail."""
+        end = max(0, len(messages) - self.keep_last_messages)
+        return [index for index in range(end) if messages[index]["role"] != "system"]
+
+    def _drop_superseded_plans(self, messages):
+        import json
+
+        # (message index, tool call index or None for the content) of every plan copy, in order
+        plan_locations = []
+        for index, message in enumerate(messages):
+            if message["role"] == "system":
+                continue
+            if self.PLAN_MARKER in (message.get("content") or ""):
+                plan_locations.append((index, None))
+            for tool_call_index, tool_call in enumerate(message.get("tool_calls") or []):
+                if self.PLAN_MARKER in tool_call["function"]["arguments"]:
+                    plan_locations.append((index, tool_call_index))
+
+        compactable = set(self._compactable_indexes(messages))
+        # The most recent plan is kept whole, wherever it is
+        for index, tool_call_index in plan_locations[:-1]:
+            if index not in compactable:
+                continue
+            if tool_call_index is None:
+                messages[index]["content"] = self.SUPERSEDED_PLAN_PLACEHOLDER
+                continue
+            # Tool call arguments must stay valid JSON, and the tool calls are shared with the caller
+            tool_calls = [dict(tool_call) for tool_call in messages[index]["tool_calls"]]
+            tool_calls[tool_call_index]["function"] = dict(
+                tool_calls[tool_call_index]["function"],
+                arguments=json.dumps({"omitted": self.SUPERSEDED_PLAN_PLACEHOLDER}),
+            )
+            messages[index]["tool_calls"] = tool_calls
+        return messages
+
+    def _shorten_observations(self, messages):
+        for index in self._compactable_indexes(messages):
+            content = messages[index].get("content") or ""
+            if not content.startswith(self.OBSERVATION_PREFIX) or len(content) <= self.max_observation_chars:
+                continue
+            if self.summarizer is not None:
+                messages[index]["content"] = f"{self.OBSERVATION_PREFIX} (summarized) {self.summarizer(content)}"
+            else:
+                messages[index]["content"] = (
+                    content[:self.max_observation_chars]
+                    + f" ... [truncated {len(content) - self.max_observation_chars} characters]"
+                )
+        return messages
+
+    def _drop_oldest_messages(self, messages):
+        dropped = set()
+        tokens = self.count_tokens(messages)
+        # Without the task statement the remaining history would be meaningless
+        task_index = next(
+            (index for index, message in enumerate(messages) if message["role"] == "user"), None
         )
+        for index in self._compactable_indexes(messages):
+            if tokens <= self.max_tokens:
+                break
+            if index in dropped or index == task_index:
+                continue
+            group = [index]
+            # The API rejects tool results whose tool calls are gone, so they go together
+            if messages[index].get("tool_calls"):
+                next_index = index + 1
+                while next_index < len(messages) and messages[next_index]["role"] == "tool":
+                    group.append(next_index)
+                    next_index += 1
+            elif messages[index]["role"] == "tool":
+                continue
+            for group_index in group:
+                tokens -= self._count_message_tokens(messages[group_index])
+                dropped.add(group_index)
+        return [message for index, message in enumerate(messages) if index not in dropped]
+
+
+class TravelPlanStreamError(ValueError):
+    """Raised when a streamed itinerary cannot be parsed into a TravelPlan."""
+
+
+class TravelPlanStreamParser:
+    """Incrementally parses the FINAL OUTPUT JSON block of a streamed itinerary response.
+
+    Feed the text deltas of an ItineraryAgent response as they arrive. The parser finds
+    the start of the TravelPlan JSON (after a ```json fence or the FINAL OUTPUT marker),
+    tracks the JSON structure as it streams in, and validates every entry of
+    "itinerary_days" as an ItineraryDay as soon as its closing brace arrives. Completed
+    days can then be evaluated or rendered before generation finishes, and a day that
+    fails validation raises TravelPlanStreamError so the caller can stop the stream.
 
-    def get_response(self, add_to_messages=True, model=None, client=None, **kwargs):
-        """Get a response from the OpenAI API.
+    Examples:
+        >>> parser = TravelPlanStreamParser()
+        >>> parser.feed('ANALYSIS: ...\\nFINAL OUTPUT:\\n```json\\n{"city": "AgentsVille", "start_date": "2025-06-10", ')
+        []
+        >>> parser.feed('"end_date": "2025-06-10", "total_cost": 0, "itinerary_days": [{"date": "2025-06-10", ')
+        []
+        >>> days = parser.feed('"weather": {"temperature": 31, "temperature_unit": "celsius", "condition": "clear"}, ')
+        >>> days = parser.feed('"activity_recommendations": []}]}\\n```')
+        >>> [str(day.date) for day in days]
+        ['2025-06-10']
+        >>> parser.close().city
+        'AgentsVille'
+
+        A marker split across two deltas is still found:
+
+        >>> parser = TravelPlanStreamParser()
+        >>> parser.feed('ANALYSIS: ...\\nFINAL OUT')
+        []
+        >>> parser.feed('PUT:\\n{"city": "AgentsVille", "start_date": "2025-06-10", "end_date": "2025-06-10", ')
+        []
+        >>> parser.feed('"total_cost": 0, "itinerary_days": []}')
+        []
+        >>> parser.close().city
+        'AgentsVille'
+    """
 
+    JSON_FENCE = "```json"
+    FINAL_OUTPUT_MARKER = "FINAL OUTPUT"
+
+    def __init__(self, on_day=None):
+        """
         Args:
-            add_to_messages (bool, optional): Whether to add the response to the chat history
-            using the add_message method and the assistant role. Defaults to True.
+            on_day (callable, optional): Called with each ItineraryDay as soon as it is validated.
+        """
+        self.on_day = on_day
+        self.days = []
+        self._text = ""
+        # Index of the first character not yet scanned
+        self._pos = 0
+        self._json_start = None
+        self._json_end = None
+        # One entry per open container: [bracket, last key seen, whether a key is expected next]
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._days_array_depth = None
+        self._day_start = None
+
+    @property
+    def response(self) -> str:
+        """The full response text received so far."""
+        return self._text
+
+    @property
+    def json_text(self) -> str | None:
+        """The TravelPlan JSON text received so far, or None if it has not started."""
+        if self._json_start is None:
+            return None
+        return self._text[self._json_start:self._json_end]
+
+    @property
+    def is_complete(self) -> bool:
+        """Whether the closing brace of the TravelPlan JSON has been received."""
+        return self._json_end is not None
+
+    def feed(self, delta: str) -> list:
+        """Consumes the next chunk of the response.
 
         Returns:
-            str: The response from the OpenAI API.
-
+            list[ItineraryDay]: The days completed by this chunk.
 
+        Raises:
+            TravelPlanStreamError: If a completed day does not validate as an ItineraryDay or
+                the JSON brackets do not match.
         """
-        response = do_chat_completion(
-            messages=self.messages,
-            model=model or self.model,
-            client=client or self.client,
-            **kwargs
-        )
-        if add_to_messages:
-            self.add_message("assistant", response)
-        return response
+        self._text += delta
+        if self._json_start is None:
+            self._find_json_start()
+            if self._json_start is None:
+                return []
+        if self._json_end is not None:
+            return []
+        return self._scan()
 
-    def chat(self, user_message, add_to_messages=True, model=None, **kwargs):
-        """Send a message to the chat and get a response.
+    def close(self):
+        """Validates the complete TravelPlan once the stream has ended.
 
-        Args:
-            user_message (str): The message to send to the chat.
+        The days already validated while streaming are reused rather than parsed again.
 
-        Returns:
-            str: The response from the OpenAI API.
+        Raises:
+            TravelPlanStreamError: If no complete TravelPlan JSON object was received.
         """
-        self.add_message("user", user_message)
-        return self.get_response(add_to_messages=add_to_messages, model=model, **kwargs)
+        import json
 
+        from models import TravelPlan
+        from pydantic import ValidationError
 
-def print_in_box(text, title="", cols=120, tab_level=0):
-    """
-    Prints the given text in a box with the specified title and dimensions.
+        if self._json_end is None:
+            raise TravelPlanStreamError(
+                f"The response ended before the TravelPlan JSON was complete: {self._text[-200:]}"
+            )
+        try:
+            plan = json.loads(self.json_text)
+            if isinstance(plan, dict) and len(self.days) == len(plan.get("itinerary_days") or []):
+                plan["itinerary_days"] = self.days
+            return TravelPlan.model_validate(plan)
+        except (ValueError, ValidationError) as e:
+            raise TravelPlanStreamError(f"Invalid TravelPlan JSON: {e}") from e
+
+    def _find_json_start(self):
+        markers = (self.JSON_FENCE, self.FINAL_OUTPUT_MARKER)
+        # Markers may be split across deltas, so look back far enough to catch the longest one
+        search_from = max(0, self._pos - (max(len(marker) for marker in markers) - 1))
+        for marker in markers:
+            marker_index = self._text.find(marker, search_from)
+            if marker_index != -1:
+                brace_index = self._text.find("{", marker_index + len(marker))
+                if brace_index != -1:
+                    self._json_start = self._pos = brace_index
+                return
+        # A response made only of the JSON object has no marker at all
+        if self._text.lstrip().startswith("{"):
+            self._json_start = self._pos = self._text.index("{")
+            return
+        self._pos = len(self._text)
+
+    def _scan(self) -> list:
+        from models import ItineraryDay
+        from pydantic import ValidationError
+
+        completed_days = []
+        text = self._text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    top = self._stack[-1] if self._stack else None
+                    if top is not None and top[0] == "{" and top[2]:
+                        top[1] = text[self._string_start + 1:pos]
+                        top[2] = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in "{[":
+                parent = self._stack[-1] if self._stack else None
+                self._stack.append([char, None, char == "{"])
+                if (
+                    char == "["
+                    and len(self._stack) == 2
+                    and parent[1] == "itinerary_days"
+                ):
+                    self._days_array_depth = len(self._stack)
+                elif char == "{" and len(self._stack) - 1 == self._days_array_depth:
+                    self._day_start = pos
+            elif char in "}]":
+                expected_opening = "{" if char == "}" else "["
+                if not self._stack or self._stack[-1][0] != expected_opening:
+                    raise TravelPlanStreamError(f"Unbalanced '{char}' at offset {pos} of the TravelPlan JSON")
+                self._stack.pop()
+
+                if char == "}" and len(self._stack) == self._days_array_depth and self._day_start is not None:
+                    try:
+                        day = ItineraryDay.model_validate_json(text[self._day_start:pos + 1])
+                    except ValidationError as e:
+                        raise TravelPlanStreamError(
+                            f"Itinerary day {len(self.days) + 1} is not a valid ItineraryDay: {e}"
+                        ) from e
+                    self._day_start = None
+                    self.days.append(day)
+                    completed_days.append(day)
+                    if self.on_day is not None:
+                        self.on_day(day)
+                elif char == "]" and len(self._stack) + 1 == self._days_array_depth:
+                    self._days_array_depth = None
+
+                if not self._stack:
+                    self._json_end = pos + 1
+                    break
+            elif char == "," and self._stack and self._stack[-1][0] == "{":
+                self._stack[-1][2] = True
+
+        self._pos = len(text) if self._json_end is None else self._json_end
+        return completed_days
+
+
+def parse_travel_plan_stream(deltas, on_day=None):
+    """Builds a TravelPlan from an iterable of streamed response deltas.
+
+    Consumption stops as soon as the TravelPlan JSON is complete or a day fails to
+    validate. In both cases the delta iterator is closed, which for
+    `ChatAgent.stream_chat` also closes the underlying HTTP stream.
 
     Args:
-        text: The text to print in the box.
-        title: The title of the box.
-        cols: The width of the box.
-        tab_level: The level of indentation for the box.
-    """
-    import textwrap
+        deltas: An iterable of text deltas, e.g. from `ChatAgent.stream_chat`.
+        on_day (callable, optional): Called with each ItineraryDay as soon as it is validated.
 
-    text = str(text)
+    Returns:
+        tuple: The TravelPlan and the full response text received.
 
-    # Make a box using extended ASCII characters
-    if cols < 4 + tab_level * SINGLE_TAB_LEVEL:
-        cols = 4 + tab_level * SINGLE_TAB_LEVEL
+    Raises:
+        TravelPlanStreamError: If the streamed response does not contain a valid TravelPlan.
+    """
+    parser = TravelPlanStreamParser(on_day=on_day)
+    deltas = iter(deltas)
+    try:
+        for delta in deltas:
+            parser.feed(delta)
+            if parser.is_complete:
+                break
+    finally:
+        if hasattr(deltas, "close"):
+            deltas.close()
+    return parser.close(), parser.response
 
-    tabs = " " * tab_level * SINGLE_TAB_LEVEL
 
-    top = (
-        tabs
-        + "\u2554"
-        + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
-        + "\u2557"
-    )
-    if tab_level == 0:
-        print()  # Print a newline before any box at level 0
+class ResponseCache:
+    """A content-addressed cache for chat completion responses.
 
-    if title:
-        # replace the middle of the top with the title
-        title = "[ " + title + " ]"
-        top = top[: (cols - len(title)) // 2] + title + top[(cols + len(title)) // 2 :]
-    print(top)
+    Responses are keyed on a hash of the canonicalized request: the messages, the model
+    and every other keyword argument passed to the completion API (temperature,
+    response_format, ...). Lookups go to an in-memory LRU tier first and then, when a
+    path is given, to an SQLite tier that survives restarts and is shared between
+    processes.
 
-    for line in text.split("\n"):
-        for wrapped_line in textwrap.wrap(
-            line, cols - 4 - tab_level * SINGLE_TAB_LEVEL
-        ):
-            print(
-                f"{tabs}\u2551 {wrapped_line:<{cols - 4 - tab_level * SINGLE_TAB_LEVEL}} \u2551"
-            )
+    Caching is opt-in: pass a ResponseCache to `do_chat_completion`, `ado_chat_completion`
+    or to a ChatAgent through its `cache` argument.
 
-    print(
-        f"{tabs}\u255a"
-        + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
-        + "\u255d"
-    )
+    Attributes:
+        hits (int): Number of lookups answered from either tier.
+        misses (int): Number of lookups that found nothing usable.
 
+    Examples:
+        >>> cache = ResponseCache()
+        >>> key = cache.make_key([{"role": "user", "content": "Hi"}], "gpt-4.1-nano", temperature=0)
+        >>> cache.get(key) is None
+        True
+        >>> cache.set(key, "Hello!")
+        >>> cache.get(key)
+        'Hello!'
+        >>> cache.stats()["hits"], cache.stats()["misses"]
+        (1, 1)
+    """
 
-def do_chat_completion(messages: list[dict[str, str]], model=None, client=None, **kwargs):
-    """A simple wrapper around OpenAI's chat completion API.
+    # Number of disk writes between two eviction passes over the SQLite tier
+    DISK_EVICTION_INTERVAL = 100
 
-    Args:
-        messages: A list of messages to send to the chat completion API.
+    def __init__(
+        self,
+        max_memory_entries=1024,
+        path=None,
+        max_disk_entries=100_000,
+        ttl_seconds=None,
+    ):
+        """
+        Args:
+            max_memory_entries (int): Size of the in-memory LRU tier.
+            path (str, optional): The SQLite database file for the on-disk tier. No disk
+                tier is used when omitted.
+            max_disk_entries (int): The on-disk tier is trimmed back to this many entries,
+                least recently used first, every DISK_EVICTION_INTERVAL writes.
+            ttl_seconds (float, optional): Entries older than this are treated as misses and
+                evicted. Entries never expire when omitted.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (created_at, content)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes_since_eviction = 0
+        if path is not None:
+            import sqlite3
+
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+            self._db.commit()
 
-    Returns:
-        str: The response from the chat completion API.
+    @staticmethod
+    def make_key(messages, model, **kwargs) -> str:
+        """Returns the cache key for a completion request.
 
-    Raises:
-        openai.OpenAIError: If the chat completion API returns an error.
+        Pydantic response_format classes are keyed on their name and JSON schema, so
+        editing the schema invalidates old entries.
+        """
+        import hashlib
+        import json
+
+        def canonicalize(value):
+            if isinstance(value, Enum):
+                return value.value
+            if isinstance(value, type) and hasattr(value, "model_json_schema"):
+                return {"name": value.__name__, "schema": value.model_json_schema()}
+            if hasattr(value, "model_dump"):
+                return value.model_dump(mode="json")
+            return str(value)
+
+        payload = json.dumps(
+            {"messages": messages, "model": model, "kwargs": kwargs},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=canonicalize,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached content for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, content = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return content
+                del self._memory[key]
+                self.evictions += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    content, created_at = row
+                    if not self._is_expired(created_at, now):
+                        self._db.execute(
+                            "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                        )
+                        self._db.commit()
+                        self._remember(key, created_at, content)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return content
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self.evictions += 1
+
+            self.misses += 1
+            return None
+
+    def set(self, key, content):
+        """Stores content under key in both tiers."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, content)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, content, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, content, now, now),
+                )
+                # Trimming scans the table, so only do it every so often
+                self._writes_since_eviction += 1
+                if self._writes_since_eviction >= self.DISK_EVICTION_INTERVAL:
+                    self._evict_disk_entries(now)
+                self._db.commit()
+
+    def clear(self):
+        """Removes every entry from both tiers. The counters are kept."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the current size of each tier."""
+        with self._lock:
+            disk_entries = (
+                self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if self._db is not None
+                else 0
+            )
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
 
-    Examples:
-        >>> messages = [
-        ...     {"role": "user", "content": "Hello, how are you?"},
-        ...     {"role": "assistant", "content": "I'm good, thanks!"},
-        ... ]
-        >>> from unittest.mock import patch
-        >>> with patch('openai.OpenAI') as mock_openai:
-        ...     # Setup mock response
-        ...     mock_client = mock_openai.return_value
-        ...     mock_chat = mock_client.chat
-        ...     mock_completions = mock_chat.completions
-        ...     mock_create = mock_completions.create
-        ...     mock_response = mock_create.return_value
-        ...     mock_response.choices = [type('obj', (object,), {'message': type('msg', (object,), {'content': "I'm good, thanks!"})()})]
-        ...     response = do_chat_completion(messages)
-        >>> response
-        "I'm good, thanks!"
-    """
-    if client is None:
-        raise ValueError("A valid OpenAI client must be provided.")
-    
-    if model is None:
-        raise ValueError("A valid model must be provided.")
+    def _is_expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
 
-    if "response_format" not in kwargs:
-        response = client.chat.completions.create(  # type: ignore
-            model=model,
-            messages=messages,  # type: ignore
-            **kwargs,  # type: ignore
-        )
-    else:
-        response = client.beta.chat.completions.parse(  # type: ignore
-            model=model,
-            messages=messages,  # type: ignore
-            **kwargs,  # type: ignore
-        )
+    def _remember(self, key, created_at, content):
+        self._memory[key] = (created_at, content)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
 
-    if hasattr(response, "error"):
-        raise RuntimeError(
-            f"OpenAI API returned an error: {str(response.error)}"
+    def _evict_disk_entries(self, now):
+        if self.ttl_seconds is not None:
+            cursor = self._db.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+        self._writes_since_eviction = 0
+        cursor = self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
         )
-
-    return response.choices[0].message.content
+        self.evictions += max(cursor.rowcount, 0)
 
 
 ACTIVITY_CALENDAR = [
@@ -532,6 +3424,213 @@ WEATHER_FORECAST = [
 ]
 
 
+class ActivityCatalog:
+    """An index over activity records for constant-time lookups.
+
+    The activities are indexed once, by id, date, city and interest, so the mocked API
+    functions no longer scan the whole calendar on every call. The records themselves
+    are the same dictionaries as in ACTIVITY_CALENDAR and are returned as-is.
+
+    Each record's city is taken from its "city" key when present and falls back to
+    `default_city` otherwise, since the location strings of the demo calendar do not
+    reliably end with the city name.
+
+    The catalog also keeps a validated-once store of `models.Activity` instances and of
+    their `model_dump()` dictionaries, so repeated lookups and equality checks skip
+    Pydantic validation and datetime parsing. The cached models are shared and must
+    not be mutated.
+
+    Examples:
+        >>> catalog = ActivityCatalog(ACTIVITY_CALENDAR, default_city="AgentsVille")
+        >>> catalog.get("event-2025-06-10-0")["name"]
+        'FutureTech Breakfast Meet-Up'
+        >>> len(catalog.get_by_date("2025-06-10", city="AgentsVille"))
+        4
+        >>> [a["activity_id"] for a in catalog.get_by_interest("tennis")]
+        ['event-2025-06-10-1', 'event-2025-06-15-3']
+        >>> catalog.get_model("event-2025-06-10-0") is catalog.get_model("event-2025-06-10-0")
+        True
+    """
+
+    def __init__(self, activities, default_city=None):
+        """
+        Args:
+            activities: An iterable of activity dictionaries shaped like ACTIVITY_CALENDAR entries.
+            default_city (str, optional): The city of records without a "city" key.
+        """
+        from collections import defaultdict
+
+        self.default_city = default_city
+        self._activities = []
+        self._by_id = {}
+        self._by_date = defaultdict(list)
+        self._by_city = defaultdict(list)
+        self._by_city_and_date = defaultdict(list)
+        self._by_interest = defaultdict(list)
+        # activity_id -> position in the catalog, used to keep results in catalog order
+        self._positions = {}
+        # activity_id -> validated models.Activity, and -> its model_dump()
+        self._models = {}
+        self._dumps = {}
+
+        for activity in activities:
+            self.add(activity)
+
+    @classmethod
+    def from_json_file(cls, path, default_city=None):
+        """Loads a catalog from a JSON array or a JSON Lines file of activity records.
+
+        JSON Lines files are read one record at a time, so large catalogs never need to
+        be held twice in memory.
+        """
+        return cls(_iter_json_records(path), default_city=default_city)
+
+    def add(self, activity):
+        """Adds an activity record to the catalog and its indexes."""
+        activity_id = activity["activity_id"]
+        if activity_id in self._by_id:
+            raise ValueError(f"Duplicate activity ID: {activity_id}")
+
+        date = activity["start_time"][:10]
+        city = activity.get("city", self.default_city)
+
+        self._positions[activity_id] = len(self._activities)
+        self._activities.append(activity)
+        self._by_id[activity_id] = activity
+        self._by_date[date].append(activity)
+        self._by_city[city].append(activity)
+        self._by_city_and_date[(city, date)].append(activity)
+        for interest in activity["related_interests"]:
+            self._by_interest[getattr(interest, "value", interest)].append(activity)
+
+    def __len__(self):
+        return len(self._activities)
+
+    def __iter__(self):
+        return iter(self._activities)
+
+    def __contains__(self, activity_id):
+        return activity_id in self._by_id
+
+    @property
+    def cities(self):
+        return set(self._by_city)
+
+    @property
+    def min_date(self):
+        return min(self._by_date) if self._by_date else None
+
+    @property
+    def max_date(self):
+        return max(self._by_date) if self._by_date else None
+
+    def get(self, activity_id):
+        """Returns the activity with the given ID, or None."""
+        return self._by_id.get(activity_id)
+
+    def get_many(self, activity_ids):
+        """Returns the known activities among activity_ids, in catalog order."""
+        activities = [
+            self._by_id[activity_id]
+            for activity_id in set(activity_ids)
+            if activity_id in self._by_id
+        ]
+        activities.sort(key=lambda activity: self._positions[activity["activity_id"]])
+        return activities
+
+    def get_by_date(self, date, city=None):
+        """Returns the activities starting on date (YYYY-MM-DD), optionally in a single city."""
+        if city is None:
+            return list(self._by_date.get(date, ()))
+        return list(self._by_city_and_date.get((city, date), ()))
+
+    def get_by_city(self, city):
+        """Returns all activities in a city."""
+        return list(self._by_city.get(city, ()))
+
+    def get_model(self, activity_id):
+        """Returns the activity with the given ID as a `models.Activity`, or None.
+
+        The record is validated on first access only; later calls return the same instance.
+        """
+        activity_model = self._models.get(activity_id)
+        if activity_model is None:
+            activity = self._by_id.get(activity_id)
+            if activity is None:
+                return None
+            from models import Activity
+
+            activity_model = self._models[activity_id] = Activity.model_validate(activity)
+        return activity_model
+
+    def get_dump(self, activity_id):
+        """Returns `get_model(activity_id).model_dump()`, computed once, or None.
+
+        A shallow copy is returned so callers may add or replace keys freely.
+        """
+        activity_dump = self._dumps.get(activity_id)
+        if activity_dump is None:
+            activity_model = self.get_model(activity_id)
+            if activity_model is None:
+                return None
+            activity_dump = self._dumps[activity_id] = activity_model.model_dump()
+        return dict(activity_dump)
+
+    def preload_models(self):
+        """Validates every activity up front, e.g. before starting a batch of evals."""
+        for activity_id in self._by_id:
+            self.get_dump(activity_id)
+
+    def get_by_interest(self, interest, city=None, date=None):
+        """Returns the activities related to an interest, optionally filtered by city and date."""
+        activities = self._by_interest.get(getattr(interest, "value", interest), ())
+        if city is not None or date is not None:
+            activities = [
+                activity
+                for activity in activities
+                if (city is None or activity.get("city", self.default_city) == city)
+                and (date is None or activity["start_time"].startswith(date))
+            ]
+        return list(activities)
+
+
+def _iter_json_records(path):
+    """Yields the records of a JSON array file or of a JSON Lines file."""
+    import json
+
+    with open(path, encoding="utf-8") as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        f.seek(0)
+        if first_char == "[":
+            yield from json.load(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+_ACTIVITY_CATALOG = None
+
+
+def get_activity_catalog() -> ActivityCatalog:
+    """Returns the catalog backing the mocked activity API, building it from ACTIVITY_CALENDAR on first use."""
+    global _ACTIVITY_CATALOG
+    if _ACTIVITY_CATALOG is None:
+        _ACTIVITY_CATALOG = ActivityCatalog(ACTIVITY_CALENDAR, default_city="AgentsVille")
+    return _ACTIVITY_CATALOG
+
+
+def set_activity_catalog(catalog: ActivityCatalog | None):
+    """Replaces the catalog backing the mocked activity API, e.g. with one loaded via ActivityCatalog.from_json_file.
+
+    Passing None restores the default catalog built from ACTIVITY_CALENDAR.
+    """
+    global _ACTIVITY_CATALOG
+    _ACTIVITY_CATALOG = catalog
+
+
 def call_activities_api_mocked(
     date: str | None = None, city: str | None = None, activity_ids: list[str] | None = None
 ) -> list[dict[str, str | int]]:
@@ -550,8 +3649,14 @@ def call_activities_api_mocked(
     """
     import datetime
 
-    # If the city is not AgentsVille, return an empty list
-    if city and city != "AgentsVille":
+    catalog = get_activity_catalog()
+
+    # An empty catalog has no date range to check against
+    if not len(catalog):
+        return []
+
+    # If the city is not in the catalog (only AgentsVille by default), return an empty list
+    if city and city not in catalog.cities:
         return []
 
     # Verify the date format
@@ -562,18 +3667,24 @@ def call_activities_api_mocked(
             print(f"Invalid date format: {date}")
             return []
 
-    # If the date is not between 2025-06-10 and 2025-06-15, return an empty list
-    if date and (date < "2025-06-10" or date > "2025-06-15"):
-        print(f"Date {date} is outside the valid range (2025-06-10 - 2025-06-15)")
+    # If the date is outside of the catalog (2025-06-10 - 2025-06-15 by default), return an empty list
+    if date and (date < catalog.min_date or date > catalog.max_date):
+        print(f"Date {date} is outside the valid range ({catalog.min_date} - {catalog.max_date})")
         return []
 
-    activities = ACTIVITY_CALENDAR
-
-    if date:
-        activities = [event for event in activities if event["start_time"].startswith(date)]
-
     if activity_ids:
-        activities = [event for event in activities if event["activity_id"] in activity_ids]
+        activities = [
+            event
+            for event in catalog.get_many(activity_ids)
+            if (not date or event["start_time"].startswith(date))
+            and (not city or event.get("city", catalog.default_city) == city)
+        ]
+    elif date:
+        activities = catalog.get_by_date(date, city=city or None)
+    elif city:
+        activities = catalog.get_by_city(city)
+    else:
+        activities = list(catalog)
 
     if not activities:
         print(f"No activities found for {date} in {city}.")
@@ -589,11 +3700,99 @@ def call_activity_by_id_api_mocked(activity_id: str):
     Returns:
         A dictionary containing the event details, or an empty dictionary if not found.
     """
-    for event in ACTIVITY_CALENDAR:
-        if event["activity_id"] == activity_id:
-            return event
-    print(f"Event with ID {activity_id} not found.")
-    return None
+    event = get_activity_catalog().get(activity_id)
+    if event is None:
+        print(f"Event with ID {activity_id} not found.")
+    return event
+
+
+class WeatherForecastStore:
+    """An index over daily forecast records, keyed by (city, date).
+
+    Single days are a dictionary lookup and date ranges a binary search over each
+    city's sorted dates, so a whole trip's forecast is fetched with one call regardless
+    of how many cities and years the store holds.
+
+    Examples:
+        >>> store = WeatherForecastStore(WEATHER_FORECAST)
+        >>> store.get("AgentsVille", "2025-06-12")["condition"]
+        'thunderstorm'
+        >>> [f["date"] for f in store.get_range("AgentsVille", "2025-06-14", "2025-06-20")]
+        ['2025-06-14', '2025-06-15']
+    """
+
+    def __init__(self, forecasts):
+        """
+        Args:
+            forecasts: An iterable of forecast dictionaries shaped like WEATHER_FORECAST entries.
+        """
+        self._by_city_and_date = {}
+        # city -> sorted list of the dates (YYYY-MM-DD) with a forecast
+        self._dates_by_city = {}
+
+        for forecast in forecasts:
+            self.add(forecast)
+
+    @classmethod
+    def from_json_file(cls, path):
+        """Loads a store from a JSON array or a JSON Lines file of forecast records."""
+        return cls(_iter_json_records(path))
+
+    def add(self, forecast):
+        """Adds a forecast record, replacing any previous forecast for the same city and date."""
+        key = (forecast["city"], forecast["date"])
+        if key not in self._by_city_and_date:
+            bisect.insort(self._dates_by_city.setdefault(forecast["city"], []), forecast["date"])
+        self._by_city_and_date[key] = forecast
+
+    def __len__(self):
+        return len(self._by_city_and_date)
+
+    @property
+    def cities(self):
+        return set(self._dates_by_city)
+
+    def date_bounds(self, city):
+        """Returns the first and last date with a forecast for city, or (None, None)."""
+        dates = self._dates_by_city.get(city)
+        if not dates:
+            return None, None
+        return dates[0], dates[-1]
+
+    def get(self, city, date):
+        """Returns the forecast for city on date, or None."""
+        return self._by_city_and_date.get((city, str(date)))
+
+    def get_range(self, city, start_date, end_date):
+        """Returns the forecasts for city from start_date to end_date (inclusive), in date order.
+
+        Dates may be given as YYYY-MM-DD strings or datetime.date objects. Days without a
+        forecast are skipped.
+        """
+        dates = self._dates_by_city.get(city, [])
+        lo = bisect.bisect_left(dates, str(start_date))
+        hi = bisect.bisect_right(dates, str(end_date))
+        return [self._by_city_and_date[(city, date)] for date in dates[lo:hi]]
+
+
+_WEATHER_FORECAST_STORE = None
+
+
+def get_weather_forecast_store() -> WeatherForecastStore:
+    """Returns the store backing the mocked weather API, building it from WEATHER_FORECAST on first use."""
+    global _WEATHER_FORECAST_STORE
+    if _WEATHER_FORECAST_STORE is None:
+        _WEATHER_FORECAST_STORE = WeatherForecastStore(WEATHER_FORECAST)
+    return _WEATHER_FORECAST_STORE
+
+
+def set_weather_forecast_store(store: WeatherForecastStore | None):
+    """Replaces the store backing the mocked weather API, e.g. with one loaded via WeatherForecastStore.from_json_file.
+
+    Passing None restores the default store built from WEATHER_FORECAST.
+    """
+    global _WEATHER_FORECAST_STORE
+    _WEATHER_FORECAST_STORE = store
 
 
 def call_weather_api_mocked(date: str, city: str) -> dict[str, str | int]:
@@ -609,10 +3808,17 @@ def call_weather_api_mocked(date: str, city: str) -> dict[str, str | int]:
     """
     import datetime
 
-    # If the city is not AgentsVille, return an empty dictionary
-    if city != "AgentsVille":
+    store = get_weather_forecast_store()
+
+    # If the city is not in the store (only AgentsVille by default), return an empty dictionary
+    if city not in store.cities:
         return {}
 
+    # Only the index holds dates in the right format, so a hit needs no further checks
+    forecast = store.get(city, date)
+    if forecast is not None:
+        return forecast
+
     # Verify the date format
     try:
         datetime.datetime.strptime(date, "%Y-%m-%d")
@@ -620,19 +3826,35 @@ def call_weather_api_mocked(date: str, city: str) -> dict[str, str | int]:
         print(f"Invalid date format: {date}")
         return {}
 
-    # If the date is not between 2025-06-10 and 2025-06-15, return an empty dictionary
-    if date < "2025-06-10" or date > "2025-06-15":
-        print(f"Date {date} is outside the valid range (2025-06-10 - 2025-06-15)")
-        return {}
+    # If the date is outside of the forecast (2025-06-10 - 2025-06-15 by default), return an empty dictionary
+    first_date, last_date = store.date_bounds(city)
+    if date < first_date or date > last_date:
+        print(f"Date {date} is outside the valid range ({first_date} - {last_date})")
+    return {}
 
-    return next(
-        (forecast for forecast in WEATHER_FORECAST if forecast["date"] == date), {}
-    )
+
+def call_weather_range_api_mocked(city: str, start_date, end_date) -> list[dict[str, str | int]]:
+    """
+    Returns the weather forecasts for every day from start_date to end_date (inclusive) in one call.
+
+    Args:
+        city: The city to get weather for.
+        start_date: The first day, as a YYYY-MM-DD string or a datetime.date.
+        end_date: The last day, as a YYYY-MM-DD string or a datetime.date.
+
+    Returns:
+        A list of forecast dictionaries in date order. Days without a forecast are skipped.
+    """
+    forecasts = get_weather_forecast_store().get_range(city, start_date, end_date)
+    if not forecasts:
+        print(f"No weather forecast found for {city} between {start_date} and {end_date}.")
+    return forecasts
 
 
 def narrate_my_trip(vacation_info, itinerary, client, model, filename="/tmp/my_trip_narration.mp3"):
     from IPython.display import Audio, Markdown, display
-    from openai import OpenAI
+
+    client = client or get_openai_client()
 
     resp = do_chat_completion(
         messages=[